@@ -0,0 +1,148 @@
+"""
+Benchmarks the album queries of MedievalDB against the nested-subquery
+f-string statements they replaced, on a synthetic library.
+
+    python bench_queries.py [--media 100000] [--albums 1000] [--backend sqlite]
+
+The SQLite backend runs on a temporary database file. The MariaDB backend
+needs an explicit --database, which is wiped and repopulated.
+"""
+
+import argparse
+import datetime
+import logging
+import os
+import random
+import tempfile
+import time
+
+import config
+import engine
+
+def legacy_query_media(db, album_id, password=None):
+    with db.connection() as cursor:
+        if password is None:
+            cursor.execute(f'select * from media where id in (select media_id from media_in_albums where album_id in (select id from albums where id={album_id} and password is NULL))')
+        else:
+            cursor.execute(f'select * from media where id in (select media_id from media_in_albums where album_id in (select id from albums where id={album_id} and password=sha2("{password}", 256)))')
+        return cursor.fetchall()
+
+def legacy_validate_album_password(db, album_id, password):
+    with db.connection() as cursor:
+        cursor.execute(f'select id from albums where id={album_id} and password=sha2("{password}", 256)')
+        res = cursor.fetchall()
+        if len(res) == 0:
+            return False
+        return res[0]['id'] == album_id
+
+def populate(db, n_media, n_albums, album_size, seed=42):
+    """
+    @db: MedievalDB instance with an empty database
+    @n_media: number of media
+    @n_albums: number of albums; every tenth one is password-protected
+    @album_size: number of media per album
+
+    Fills the database with a synthetic library and returns the list of
+    (album_id, password) tuples.
+    """
+
+    rng = random.Random(seed)
+    start = datetime.datetime(2000, 1, 1)
+
+    records = []
+    for i in range(n_media):
+        records.append({
+            'filename': f'/library/{i//1000:04d}/IMG_{i:06d}.jpg',
+            'thumbnail': f'{i:032x}',
+            'mimetype': 'image/jpeg',
+            'timestamp': start + datetime.timedelta(seconds=rng.randrange(25*365*86400)),
+            'width': 4000,
+            'height': 3000,
+        })
+        if len(records) == 1000:
+            db.add_media_batch(records)
+            records = []
+    db.add_media_batch(records)
+
+    albums = []
+    for i in range(n_albums):
+        password = f'password{i}' if i % 10 == 0 else None
+        albums.append((db.add_album(f'album {i}', password=password), password))
+
+    with db.connection() as cursor:
+        cursor.execute('select min(id) as first from media')
+        first = cursor.fetchall()[0]['first']
+
+    with db.transaction() as cursor:
+        for album_id, password in albums:
+            media_ids = rng.sample(range(first, first+n_media), album_size)
+            cursor.executemany('insert into media_in_albums (album_id,media_id) values (?,?)', [(album_id, media_id) for media_id in media_ids])
+
+    return albums
+
+def timeit(func, calls):
+    start = time.perf_counter()
+    for args in calls:
+        func(*args)
+    return time.perf_counter() - start
+
+def main():
+    argparser = argparse.ArgumentParser(description='Benchmarks the MedievalDB album queries.')
+    argparser.add_argument('--backend', choices=('sqlite', 'mariadb'), default='sqlite', help='storage backend (default: sqlite)')
+    argparser.add_argument('--database', help='MariaDB database to wipe and use (required with --backend mariadb)')
+    argparser.add_argument('--media', type=int, default=100000, help='number of media (default: 100000)')
+    argparser.add_argument('--albums', type=int, default=1000, help='number of albums (default: 1000)')
+    argparser.add_argument('--album-size', type=int, default=100, help='number of media per album (default: 100)')
+    argparser.add_argument('--calls', type=int, default=2000, help='number of calls per query (default: 2000)')
+    args = argparser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='medieval-bench-')
+    config.HOME_DIR = workdir
+    config.THUMBNAIL_DIR = workdir+'/thumbnails'
+
+    if args.backend == 'sqlite':
+        backend = engine.SQLiteBackend(path=os.path.join(workdir, 'bench.sqlite'))
+    elif args.database is None:
+        argparser.error('--backend mariadb requires --database.')
+    else:
+        backend = engine.MariaDBBackend(database=args.database)
+
+    db = engine.MedievalDB(backend=backend)
+    db.create_empty_database(overwrite=True)
+
+    start = time.perf_counter()
+    albums = populate(db, args.media, args.albums, min(args.album_size, args.media))
+    print(f'{backend.name}: populated {args.media} media and {args.albums} albums in {time.perf_counter()-start:.1f}s.')
+
+    rng = random.Random(1)
+    calls = [rng.choice(albums) for i in range(args.calls)]
+    locked = [album for album in albums if album[1] is not None]
+    password_calls = [rng.choice(locked) for i in range(args.calls)] if len(locked) > 0 else []
+
+    # both forms have to agree before their timings mean anything:
+    for album_id, password in calls[:20]:
+        assert sorted(entry['id'] for entry in legacy_query_media(db, album_id, password)) == sorted(entry['id'] for entry in db.query_media(album_id, password))
+
+    benchmarks = [
+        ('query_media', legacy_query_media, lambda db, album_id, password: db.query_media(album_id, password), calls),
+        ('validate_album_password', legacy_validate_album_password, lambda db, album_id, password: db.validate_album_password(album_id, password), password_calls),
+    ]
+
+    print(f'{"query":<24} {"legacy (ms/call)":>17} {"prepared (ms/call)":>19} {"speedup":>8}')
+    for name, legacy, current, arguments in benchmarks:
+        if len(arguments) == 0:
+            continue
+        arguments = [(db, *call) for call in arguments]
+        # warm up the caches and the prepared statements:
+        timeit(legacy, arguments[:50])
+        timeit(current, arguments[:50])
+
+        t_legacy = timeit(legacy, arguments)
+        t_current = timeit(current, arguments)
+        print(f'{name:<24} {1000*t_legacy/len(arguments):>17.3f} {1000*t_current/len(arguments):>19.3f} {t_legacy/t_current:>7.2f}x')
+
+    db.video_thumbnailer.shutdown()
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.WARNING)
+    main()
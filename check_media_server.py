@@ -0,0 +1,108 @@
+"""
+Checks the cast media server against a local HTTP client, without a cast
+device: plain, ranged, conditional and HEAD requests, and that media are
+only served under the token handed out by cast_source().
+
+    python check_media_server.py [--size 1048576]
+
+The media live in a temporary SQLite database; nothing is transcoded.
+"""
+
+import argparse
+import datetime
+import http.client
+import logging
+import os
+import sys
+import tempfile
+import urllib.parse
+
+import config
+import engine
+
+def request(server, method, path, headers=None):
+    connection = http.client.HTTPConnection(*server.server_address, timeout=10)
+    try:
+        connection.request(method, path, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        connection.close()
+
+def main():
+    argparser = argparse.ArgumentParser(description='Checks the cast media server with a local HTTP client.')
+    argparser.add_argument('--size', type=int, default=1024*1024, help='size of the served file, in bytes (default: 1048576)')
+    args = argparser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='medieval-server-')
+    config.HOME_DIR = workdir
+    config.THUMBNAIL_DIR = workdir+'/thumbnails'
+    config.RENDITION_DIR = workdir+'/renditions'
+
+    content = os.urandom(args.size)
+    filename = os.path.join(workdir, 'IMG_0001.jpg')
+    with open(filename, 'wb') as f:
+        f.write(content)
+
+    db = engine.MedievalDB(backend=engine.SQLiteBackend(path=os.path.join(workdir, 'check.sqlite')))
+    db.create_empty_database(overwrite=True)
+    media_id = db.add_media_batch([{
+        'filename': filename,
+        'thumbnail': 32*'0',
+        'mimetype': 'image/jpeg',
+        'timestamp': datetime.datetime(2000, 1, 1),
+        'width': 4000,
+        'height': 3000,
+    }])[0]
+
+    server = engine.MediaServer(db, host='127.0.0.1', port=0)
+    server.start()
+    failures = []
+
+    def check(name, condition):
+        print(f'{"ok" if condition else "FAILED"}: {name}')
+        if not condition:
+            failures.append(name)
+
+    try:
+        check('media are not served by id', request(server, 'GET', f'/media/{media_id}')[0] == 404)
+
+        url, mimetype = server.cast_source(media_id)
+        path = urllib.parse.urlsplit(url).path
+        check('cast_source() returns the mimetype', mimetype == 'image/jpeg')
+        check('unknown tokens are not served', request(server, 'GET', '/media/unknown')[0] == 404)
+
+        status, headers, body = request(server, 'GET', path)
+        check('GET serves the file', status == 200 and body == content and headers['Content-Type'] == 'image/jpeg')
+
+        status, headers, body = request(server, 'HEAD', path)
+        check('HEAD sends no body', status == 200 and body == b'' and int(headers['Content-Length']) == args.size)
+
+        start, stop = args.size//3, args.size//2
+        status, headers, body = request(server, 'GET', path, {'Range': f'bytes={start}-{stop-1}'})
+        check('a range is served with 206', status == 206 and body == content[start:stop] and headers['Content-Range'] == f'bytes {start}-{stop-1}/{args.size}')
+
+        status, headers, body = request(server, 'GET', path, {'Range': 'bytes=-100'})
+        check('a suffix range is served', status == 206 and body == content[-100:])
+
+        status = request(server, 'GET', path, {'Range': f'bytes={args.size}-'})[0]
+        check('an unsatisfiable range is answered with 416', status == 416)
+
+        etag = headers['ETag']
+        check('If-None-Match is answered with 304', request(server, 'GET', path, {'If-None-Match': etag})[0] == 304)
+        check('If-Modified-Since is answered with 304', request(server, 'GET', path, {'If-Modified-Since': headers['Last-Modified']})[0] == 304)
+
+        status, headers, body = request(server, 'GET', path, {'Range': 'bytes=0-99', 'If-Range': '"stale"'})
+        check('a stale If-Range gets the whole file', status == 200 and body == content)
+
+        check('the token is kept across casts', server.cast_source(media_id)[0] == url)
+    finally:
+        server.stop()
+        db.video_thumbnailer.shutdown()
+
+    if len(failures) > 0:
+        sys.exit(f'{len(failures)} checks failed.')
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.WARNING)
+    main()
@@ -4,3 +4,90 @@ MDB_DBNAME = 'dbname'
 
 HOME_DIR = '/path/to/.medieval'
 THUMBNAIL_DIR = HOME_DIR+'/thumbnails'
+
+# Import media where they are; otherwise they are copied into ALBUM_DIR, in a
+# directory per day they were taken:
+IMPORT_IN_PLACE = True
+ALBUM_DIR = HOME_DIR+'/albums'
+
+# Remove media imported in place from the library when their files are gone
+# from the imported directory; otherwise deleted files are only reported:
+IMPORT_REMOVE_DELETED = False
+
+# Number of threads that copy media into ALBUM_DIR on import, next to the
+# decoding workers, and the buffer size of a streaming copy:
+IMPORT_COPY_WORKERS = 4
+IMPORT_COPY_BUFFER = 8*1024*1024
+
+# Number of worker processes used to decode media on import (None: one per CPU):
+IMPORT_WORKERS = None
+
+# Number of imported media committed to the database per transaction:
+IMPORT_CHUNK_SIZE = 256
+
+# Stat every file on import, even in directories that have not changed since
+# the previous import; slower, but catches files rewritten in place:
+IMPORT_THOROUGH = False
+
+# Maximum number of files per source device that an import has in flight at
+# once; None shares the worker pool evenly between the devices being imported:
+IMPORT_DEVICE_CONCURRENCY = None
+
+# Preview pyramid levels generated on import (grid thumbnail, mid-size, screen-size):
+PREVIEW_SIZES = (256, 1024, 2560)
+
+# Disk budget of the preview cache in THUMBNAIL_DIR, in bytes:
+THUMBNAIL_CACHE_SIZE = 2*1024**3
+
+# Number of concurrent ffmpeg processes extracting video thumbnails, and the
+# time (in seconds) after which a single extraction is abandoned:
+VIDEO_WORKERS = 2
+VIDEO_THUMBNAIL_TIMEOUT = 30
+
+# Memory budget of the decoded thumbnail textures, in bytes, and the number of
+# background threads that load them:
+TEXTURE_CACHE_SIZE = 256*1024**2
+THUMBNAIL_LOADERS = 4
+
+# Number of media rows per page when the timeline is loaded lazily:
+MEDIA_PAGE_SIZE = 500
+
+# Maximum number of pooled database connections, and how long (in seconds)
+# a thread waits for one when all of them are busy:
+DB_POOL_SIZE = 8
+DB_POOL_TIMEOUT = 30
+
+# Seconds a pooled connection may sit idle before it is pinged on checkout,
+# to replace connections the server has closed (keep it under wait_timeout):
+DB_POOL_CHECK_AFTER = 30
+
+# Storage backend: 'mariadb' (a MariaDB server, configured above) or 'sqlite'
+# (an embedded database file, for single-user installs):
+DB_BACKEND = 'mariadb'
+SQLITE_DATABASE = HOME_DIR+'/medieval.sqlite'
+
+# SQLite page cache and memory-mapped I/O sizes, in bytes:
+SQLITE_CACHE_SIZE = 64*1024**2
+SQLITE_MMAP_SIZE = 256*1024**2
+
+# Memory budget of the decoded viewer frames, in bytes, the number of
+# background threads that decode them, and how many media on either side of
+# the viewed one are prefetched:
+FRAME_CACHE_SIZE = 256*1024**2
+FRAME_LOADERS = 2
+FRAME_PREFETCH = 2
+
+# Address and port of the built-in server that cast devices fetch media
+# from (CASTER_IP None: the address of the interface of the default route):
+CASTER_IP = None
+CASTER_PORT = 8000
+
+# Cast renditions of media that cast devices cannot play as they are: their
+# directory and disk budget in bytes, the number of concurrent transcoding
+# jobs, the time (in seconds) after which a job is abandoned, and how many
+# of the following media are rendered in the background when one is cast:
+RENDITION_DIR = HOME_DIR+'/renditions'
+RENDITION_CACHE_SIZE = 20*1024**3
+TRANSCODE_WORKERS = 1
+TRANSCODE_TIMEOUT = 3600
+TRANSCODE_PREFETCH = 2
@@ -1,10 +1,8 @@
 """
 """
 
-import mariadb as mdb
 import os
 import re
-import random, string
 from PIL import Image, ImageOps, ExifTags
 import ffmpeg
 import logging
@@ -12,14 +10,47 @@ import mimetypes
 import dateutil.parser as parser
 import shutil
 import time
+import io
+import struct
+import hashlib
+import filecmp
+import subprocess
+import json
+import math
+import itertools
+import collections
+import queue
+import contextlib
+import tempfile
+import datetime
+import sqlite3
+import concurrent.futures
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import config
 
+# the MariaDB backend is optional; the SQLite backend needs nothing beyond
+# the standard library:
+try:
+    import mariadb as mdb
+except ImportError:
+    mdb = None
+
+# reflinks need fcntl.ioctl(), which only POSIX systems have; elsewhere
+# copy_file() falls back to a regular copy:
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 # Casting support:
 import pychromecast as cc
 import threading
 import socket
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+import secrets
+import email.utils
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 __version__ = '0.1.0'
 
@@ -30,6 +61,110 @@ dbconfig = {
     'database': config.MDB_DBNAME
 }
 
+def merge_duplicate_filenames(cursor):
+    """
+    @cursor: cursor on the database being migrated
+
+    Merges the media rows that share a filename into the oldest of them, so
+    that filenames can be made unique: earlier imports added a file again
+    on every re-import in copy mode, and gave the same album path to files
+    of the same name taken on the same day. The album memberships of the
+    merged rows move to the surviving row, which also takes over a
+    description if it has none. Their previews are left to
+    collect_preview_garbage().
+    """
+
+    cursor.execute('select id, filename, description from media order by id')
+    media = {}
+    for entry in cursor.fetchall():
+        media.setdefault(entry['filename'], []).append(entry)
+
+    merged = 0
+    for filename, entries in media.items():
+        if len(entries) < 2:
+            continue
+
+        keep = entries[0]
+        cursor.execute('select album_id from media_in_albums where media_id=?', (keep['id'],))
+        albums = {entry['album_id'] for entry in cursor.fetchall()}
+        for entry in entries[1:]:
+            cursor.execute('select album_id from media_in_albums where media_id=?', (entry['id'],))
+            for album_id in [album['album_id'] for album in cursor.fetchall()]:
+                if album_id not in albums:
+                    cursor.execute('update media_in_albums set media_id=? where album_id=? and media_id=?', (keep['id'], album_id, entry['id']))
+                    albums.add(album_id)
+            if keep['description'] is None and entry['description'] is not None:
+                keep['description'] = entry['description']
+                cursor.execute('update media set description=? where id=?', (entry['description'], keep['id']))
+            cursor.execute('delete from media_in_albums where media_id=?', (entry['id'],))
+            cursor.execute('delete from media where id=?', (entry['id'],))
+            merged += 1
+        logging.warning(f'merged {len(entries)} media rows of {filename} into media {keep["id"]}.')
+
+    if merged > 0:
+        logging.warning(f'merged {merged} duplicate media rows.')
+
+# Schema migrations: each entry lists the statements that bring the schema
+# from the previous version to the given one; a callable is called with the
+# cursor instead, for data that has to be fixed up in between. Version 1 is
+# the original schema, so databases that predate the migrations are picked
+# up as-is.
+migrations = [
+    (1, [
+        'create table if not exists media (id int unsigned not null auto_increment primary key, filename varchar(256) not null, thumbnail varchar(32) not null, mimetype varchar(32), timestamp datetime, width smallint unsigned, height smallint unsigned, orientation tinyint, make varchar(32), model varchar(32), description varchar(1024))',
+        'create table if not exists collections (id int unsigned not null auto_increment, name varchar(16) not null, password char(64) default NULL, primary key(id))',
+        'create table if not exists albums (id int unsigned not null auto_increment, name varchar(100) not null, password char(64) default NULL, primary key(id))',
+        'create table if not exists media_in_albums (album_id int unsigned not null, media_id int unsigned not null, foreign key (album_id) references albums(id), foreign key (media_id) references media(id), unique (album_id, media_id))',
+        'create table if not exists albums_in_collections (collection_id int unsigned not null, album_id int unsigned not null, foreign key (collection_id) references collections(id), foreign key (album_id) references albums(id), unique (collection_id, album_id))',
+    ]),
+    (2, [
+        # filenames are case-sensitive (see version 6), so files whose names
+        # only differ in case are not duplicates:
+        'alter table media modify filename varchar(256) binary not null',
+        # duplicate detection on import (known_media, media_in_database):
+        merge_duplicate_filenames,
+        'create unique index if not exists media_filename on media (filename)',
+    ]),
+    (3, [
+        'create table if not exists manifest (path varchar(256) not null primary key, size bigint unsigned, mtime bigint unsigned not null, is_dir bool not null default 0)',
+    ]),
+    (4, [
+        'create table if not exists media_metadata (media_id int unsigned not null primary key, metadata json not null, foreign key (media_id) references media(id) on delete cascade)',
+    ]),
+    (5, [
+        # timeline order and keyset pagination (query_media, query_media_page):
+        'create index if not exists media_timestamp on media (timestamp, id)',
+        # album joins from the media side:
+        'create index if not exists media_in_albums_media on media_in_albums (media_id, album_id)',
+        'create index if not exists albums_in_collections_album on albums_in_collections (album_id, collection_id)',
+        # shared previews (remove_media, collect_preview_garbage):
+        'create index if not exists media_thumbnail on media (thumbnail)',
+    ]),
+    (6, [
+        # paths are case-sensitive: compare filenames and manifest paths byte
+        # for byte, so that a directory prefix does not match a sibling
+        # whose name only differs in case (known_media, load_manifest):
+        'alter table media modify filename varchar(256) binary not null',
+        'alter table manifest modify path varchar(256) binary not null',
+    ]),
+]
+
+# SQLite has no auto_increment: integer primary keys are assigned by the
+# database itself. Later migrations are shared by both backends, except for
+# the collation changes: SQLite compares text byte for byte already.
+sqlite_migrations = [
+    (1, [
+        'create table if not exists media (id integer primary key autoincrement, filename varchar(256) not null, thumbnail varchar(32) not null, mimetype varchar(32), timestamp datetime, width smallint unsigned, height smallint unsigned, orientation tinyint, make varchar(32), model varchar(32), description varchar(1024))',
+        'create table if not exists collections (id integer primary key autoincrement, name varchar(16) not null, password char(64) default NULL)',
+        'create table if not exists albums (id integer primary key autoincrement, name varchar(100) not null, password char(64) default NULL)',
+        'create table if not exists media_in_albums (album_id int unsigned not null, media_id int unsigned not null, foreign key (album_id) references albums(id), foreign key (media_id) references media(id), unique (album_id, media_id))',
+        'create table if not exists albums_in_collections (collection_id int unsigned not null, album_id int unsigned not null, foreign key (collection_id) references collections(id), foreign key (album_id) references albums(id), unique (collection_id, album_id))',
+    ]),
+    (2, migrations[1][1][1:]),
+] + migrations[2:5] + [(6, [])]
+
+media_columns = ('id', 'filename', 'thumbnail', 'mimetype', 'timestamp', 'width', 'height', 'orientation', 'make', 'model', 'description')
+
 exif_ids = {
     'Make': 271,
     'Model': 272,
@@ -41,19 +176,743 @@ exif_ids = {
     'ExifImageHeight': 40963,
 }
 
+class ConnectionPool:
+    """
+    A bounded pool of database connections. Connections are opened lazily,
+    up to the pool size, and handed out most-recently-used first so that a
+    mostly idle application keeps reusing the same warm connection. When
+    all connections are busy, acquire() blocks until one is released or the
+    timeout expires.
+
+    Servers close connections that sit idle for too long (MariaDB's
+    wait_timeout), so a connection that has been idle for a while is
+    checked before it is handed out, and replaced if it is dead. A
+    connection that broke while in use is discard()ed instead of released.
+    """
+
+    def __init__(self, connect, size=8, timeout=30, check=None, check_after=30):
+        """
+        @connect: callable that opens a new database connection
+        @size: maximum number of open connections (default: 8)
+        @timeout: seconds to wait for a free connection (default: 30)
+        @check: callable that raises if the connection it is passed is no
+                longer usable (default: none)
+        @check_after: seconds a connection may be idle before it is checked
+                      on checkout (default: 30)
+        """
+
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.check = check
+        self.check_after = check_after
+        # (connection, time it was released):
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.in_use = 0
+        self.acquired = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.reconnects = 0
+
+    def acquire(self):
+        try:
+            db, released = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                create = self.created < self.size
+                if create:
+                    self.created += 1
+            if create:
+                db = self.open()
+                released = None
+            else:
+                start = time.perf_counter()
+                try:
+                    db, released = self.idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise TimeoutError(f'no database connection became available in {self.timeout}s.')
+                with self.lock:
+                    self.waits += 1
+                    self.wait_time += time.perf_counter() - start
+
+        if released is not None and self.check is not None and time.monotonic() - released > self.check_after:
+            try:
+                self.check(db)
+            except Exception as e:
+                logging.info(f'replacing a dead database connection: {e!r}')
+                self.close_quietly(db)
+                db = self.open()
+                with self.lock:
+                    self.reconnects += 1
+
+        with self.lock:
+            self.in_use += 1
+            self.acquired += 1
+        return db
+
+    def open(self):
+        # the slot in self.created is already taken:
+        try:
+            return self.connect()
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+
+    def release(self, db):
+        with self.lock:
+            self.in_use -= 1
+        self.idle.put((db, time.monotonic()))
+
+    def discard(self, db):
+        """
+        Closes a connection that is checked out but no longer usable, and
+        frees its slot in the pool.
+        """
+
+        self.close_quietly(db)
+        with self.lock:
+            self.in_use -= 1
+            self.created -= 1
+
+    def close_quietly(self, db):
+        try:
+            db.close()
+        except Exception:
+            pass
+
+    def close(self):
+        while True:
+            try:
+                db, released = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            db.close()
+            with self.lock:
+                self.created -= 1
+
+    def statistics(self):
+        with self.lock:
+            return {
+                'size': self.size,
+                'created': self.created,
+                'in_use': self.in_use,
+                'acquired': self.acquired,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'reconnects': self.reconnects,
+            }
+
+class Connection:
+    """
+    A pooled database connection together with the statements prepared on
+    it. Each statement is prepared the first time it is executed on the
+    connection and its cursor is reused from then on, so the server parses
+    and plans it only once per connection.
+    """
+
+    def __init__(self, backend):
+        """
+        @backend: storage backend that opens the connection
+        """
+
+        self.backend = backend
+        self.db = backend.connect()
+        self.statements = {}
+
+    def cursor(self):
+        return self.backend.cursor(self.db)
+
+    def execute(self, statement, params=()):
+        cursor = self.statements.get(statement, None)
+        if cursor is None:
+            cursor = self.statements[statement] = self.backend.prepare(self.db)
+        cursor.execute(statement, params)
+        return cursor
+
+    def ping(self):
+        self.backend.ping(self.db)
+
+    def close(self):
+        for cursor in self.statements.values():
+            cursor.close()
+        self.statements.clear()
+        self.db.close()
+
+class MariaDBBackend:
+    """
+    Storage on a MariaDB server, configured by `dbconfig`.
+    """
+
+    name = 'mariadb'
+    migrations = migrations
+    # filenames and paths have a binary collation (migration 6), so LIKE is
+    # case-sensitive:
+    prefix_match = 'like ?'
+
+    def __init__(self, **kwargs):
+        if mdb is None:
+            raise ImportError('the mariadb backend requires the mariadb module.')
+
+        self.Error = mdb.Error
+        self.dbconfig = {**dbconfig, **kwargs}
+
+    def connect(self):
+        db = mdb.connect(**self.dbconfig)
+        db.autocommit = True
+        return db
+
+    def cursor(self, db):
+        return db.cursor(dictionary=True) # for mariadb module
+
+    def prepare(self, db):
+        # a prepared cursor keeps its server-side statement as long as it is
+        # executed with the same statement text:
+        return db.cursor(dictionary=True, prepared=True)
+
+    def ping(self, db):
+        # raises if the server has closed the connection:
+        db.ping()
+
+    def prefix_pattern(self, path):
+        return path_prefix_pattern(path)
+
+    def begin(self, db):
+        db.begin()
+
+    def upsert(self, table, columns, key, update):
+        """
+        @table: table name
+        @columns: inserted columns
+        @key: column of the unique key that identifies existing rows
+        @update: columns overwritten when the row already exists
+
+        Returns a parameterized insert-or-update statement.
+        """
+
+        changes = ', '.join(f'{column}=values({column})' for column in update)
+        return f'insert into {table} ({",".join(columns)}) values ({",".join("?"*len(columns))}) on duplicate key update {changes}'
+
+class SQLiteBackend:
+    """
+    Embedded storage in a single SQLite file, for single-user installs,
+    tests and benchmarks. The database runs in WAL mode, so readers (the
+    timeline, the thumbnail loaders) never block on the import writer, and
+    every pooled connection is tuned with the pragmas below.
+
+    An in-memory database (':memory:') is private to a single connection,
+    so use a temporary file instead when the pool may open several.
+    """
+
+    name = 'sqlite'
+    migrations = sqlite_migrations
+    Error = sqlite3.Error
+    # SQLite's LIKE ignores case, GLOB does not (and uses the index too):
+    prefix_match = 'glob ?'
+
+    def __init__(self, path=None):
+        self.path = config.SQLITE_DATABASE if path is None else path
+
+        # timestamps are stored as ISO strings, so they sort chronologically:
+        sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat(' '))
+        sqlite3.register_converter('datetime', lambda value: datetime.datetime.fromisoformat(value.decode()))
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=config.DB_POOL_TIMEOUT, detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None, check_same_thread=False)
+        db.row_factory = dictionary_row
+        db.create_function('sha2', 2, sha2, deterministic=True)
+
+        db.execute('pragma journal_mode=wal')
+        # with WAL, a commit is durable once the log is checkpointed; an OS
+        # crash may lose the last transactions, but never corrupts the file:
+        db.execute('pragma synchronous=normal')
+        db.execute('pragma foreign_keys=on')
+        db.execute('pragma temp_store=memory')
+        db.execute(f'pragma cache_size={-(config.SQLITE_CACHE_SIZE//1024)}')
+        db.execute(f'pragma mmap_size={config.SQLITE_MMAP_SIZE}')
+        return db
+
+    def cursor(self, db):
+        return db.cursor()
+
+    def prepare(self, db):
+        # sqlite3 keeps compiled statements in a per-connection cache keyed
+        # by the statement text, so any cursor reuses them:
+        return db.cursor()
+
+    def ping(self, db):
+        # a local file does not time out.
+        pass
+
+    def prefix_pattern(self, path):
+        """
+        Returns a GLOB pattern that matches everything below directory @path.
+        """
+
+        prefix = os.path.abspath(path).rstrip('/') + '/'
+        return re.sub(r'([*?[])', r'[\1]', prefix) + '*'
+
+    def begin(self, db):
+        # take the write lock up front; a deferred transaction that later
+        # writes may fail with SQLITE_BUSY without waiting for the lock:
+        db.execute('begin immediate')
+
+    def upsert(self, table, columns, key, update):
+        """
+        @table: table name
+        @columns: inserted columns
+        @key: column of the unique key that identifies existing rows
+        @update: columns overwritten when the row already exists
+
+        Returns a parameterized insert-or-update statement.
+        """
+
+        changes = ', '.join(f'{column}=excluded.{column}' for column in update)
+        return f'insert into {table} ({",".join(columns)}) values ({",".join("?"*len(columns))}) on conflict ({key}) do update set {changes}'
+
+def create_backend(name=None):
+    """
+    @name: 'mariadb' or 'sqlite' (default: config.DB_BACKEND)
+
+    Returns the storage backend used by MedievalDB.
+    """
+
+    if name is None:
+        name = config.DB_BACKEND
+
+    if name == 'mariadb':
+        return MariaDBBackend()
+    elif name == 'sqlite':
+        return SQLiteBackend()
+    else:
+        raise ValueError(f'database backend {name} not recognized.')
+
+def dictionary_row(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+def sha2(value, bits):
+    """
+    SQLite implementation of MariaDB's SHA2(), used for album passwords.
+    """
+
+    if value is None or bits not in (224, 256, 384, 512):
+        return None
+    return hashlib.new(f'sha{bits}', str(value).encode()).hexdigest()
+
+class ImportJob:
+    """
+    A media import that runs in a background thread.
+
+    While the import runs, the job counts the files 'seen' by the scan and,
+    of those, the ones 'imported', 'skipped' (unchanged, already in the
+    database, or not media) and 'failed'. The callbacks are called from the
+    import thread: on_batch(job, rows) with the rows of every committed
+    chunk, on_progress(job) at most every @progress_interval seconds, and
+    on_done(job) when the import has finished, failed or been cancelled. A
+    GUI has to hand them over to its main loop.
+    """
+
+    def __init__(self, paths, on_batch=None, on_progress=None, on_done=None, progress_interval=0.25):
+        self.paths = list(paths)
+        self.on_batch = on_batch
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.progress_interval = progress_interval
+
+        self.seen = 0
+        self.imported = 0
+        self.skipped = 0
+        self.failed = 0
+
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.thread = None
+        self.cancel_event = threading.Event()
+        self.last_progress = 0
+
+    def __repr__(self):
+        return f'<ImportJob {", ".join(self.paths)}>'
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def elapsed(self):
+        if self.started is None:
+            return 0
+        return (time.perf_counter() if self.finished is None else self.finished) - self.started
+
+    def throughput(self):
+        """
+        Returns the number of imported files per second.
+        """
+
+        elapsed = self.elapsed()
+        return self.imported/elapsed if elapsed > 0 else 0
+
+    def progress(self):
+        return {
+            'seen': self.seen,
+            'imported': self.imported,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'throughput': self.throughput(),
+            'elapsed': self.elapsed(),
+            'cancelled': self.cancelled,
+            'finished': self.finished is not None,
+        }
+
+    def add_batch(self, rows):
+        if self.on_batch is not None and len(rows) > 0:
+            self.on_batch(self, rows)
+
+    def report_progress(self, force=False):
+        now = time.perf_counter()
+        if self.on_progress is not None and (force or now - self.last_progress >= self.progress_interval):
+            self.last_progress = now
+            self.on_progress(self)
+
+    def run(self, db, **kwargs):
+        self.started = time.perf_counter()
+        try:
+            db.import_media_from_directories(self.paths, job=self, **kwargs)
+        except Exception as e:
+            self.error = e
+            logging.error(f'import of {", ".join(self.paths)} failed: {e!r}')
+        finally:
+            self.finished = time.perf_counter()
+            self.report_progress(force=True)
+            if self.on_done is not None:
+                self.on_done(self)
+
+    def start(self, db, **kwargs):
+        """
+        @db: MedievalDB instance to import into
+        @kwargs: import_media_from_directories() arguments
+
+        Starts the import in a background thread and returns the job.
+        """
+
+        self.thread = threading.Thread(target=self.run, args=(db,), kwargs=kwargs, name='import', daemon=True)
+        self.thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        self.thread.join(timeout)
+
+class ImportSource:
+    """
+    One directory of an import (see MedievalDB.import_media_from_directories()).
+
+    The directory is walked by scan_directory() in a thread of its own, so
+    that a slow device does not hold up the other directories; the entries
+    it finds are queued for the import loop, which compares them against
+    the manifest of the previous import and collects the manifest updates
+    and the report of the directory. The @ready event, shared by all the
+    sources of an import, is set whenever an entry is queued, so the import
+    loop can sleep until there is something to do.
+    """
+
+    def __init__(self, db, path, thorough, job, ready):
+        self.db = db
+        self.path = path
+        self.job = job
+        self.device = os.stat(path).st_dev
+
+        self.known = db.known_media(path)
+        self.manifest = db.load_manifest(path)
+        self.known_dirs = {} if thorough else {entry: self.manifest[entry][1] for entry in self.manifest if self.manifest[entry][2]}
+
+        self.seen = set()
+        # number of files (not directories) found by the scan:
+        self.files = 0
+        self.manifest_updates = []
+        # {filename: (size, mtime)} of the files handed to the workers:
+        self.candidates = {}
+        # files that have been imported before:
+        self.changed = set()
+        self.report = {'new': 0, 'changed': 0, 'unchanged': 0, 'deleted': [], 'thumbnails': {}}
+
+        self.entries = queue.Queue(maxsize=4096)
+        self.ready = ready
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.scan, name=f'scan {path}', daemon=True)
+        self.exhausted = False
+        self.complete = False
+
+    def __repr__(self):
+        return f'<ImportSource {self.path}>'
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def scan(self):
+        complete = False
+        errors = []
+        try:
+            for entry in scan_directory(self.path, self.known_dirs, errors):
+                if not self.put(entry):
+                    return
+            # files below unreadable entries are missing, not deleted:
+            complete = len(errors) == 0
+            if not complete:
+                logging.warning(f'{len(errors)} entries of {self.path} could not be read, deleted files will not be reported.')
+        except Exception as e:
+            logging.error(f'failed to scan {self.path}: {e!r}')
+        finally:
+            # the end of the scan, and whether it saw the whole tree:
+            self.put(complete)
+
+    def put(self, entry):
+        while not self.stopped.is_set() and not self.job.cancelled:
+            try:
+                self.entries.put(entry, timeout=0.1)
+                self.ready.set()
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def next_candidate(self):
+        """
+        Returns the next file found by the scan that needs to be imported,
+        or None if there is none for now. Sets @exhausted once the scan has
+        ended and all of its entries have been seen.
+        """
+
+        while not self.exhausted:
+            try:
+                entry = self.entries.get_nowait()
+            except queue.Empty:
+                return None
+
+            if isinstance(entry, bool):
+                self.exhausted = True
+                self.complete = entry
+                return None
+
+            filename, size, mtime, is_dir = entry
+            self.seen.add(filename)
+            previous = self.manifest.get(filename, None)
+
+            if is_dir:
+                if previous is None or previous[1] != mtime:
+                    self.manifest_updates.append((filename, None, mtime, True))
+                continue
+
+            self.job.seen += 1
+            self.files += 1
+            if size is None:
+                if previous is not None:
+                    # the directory is unchanged, and so is the file.
+                    self.report['unchanged'] += 1
+                    self.job.skipped += 1
+                    continue
+                try:
+                    stat = os.stat(filename)
+                except OSError as e:
+                    # the file has been removed or become unreadable since the
+                    # scan; it is still counted as seen, so it is not reported
+                    # as deleted before the next import has a look at it.
+                    logging.warning(f'cannot access {filename}: {e}')
+                    self.job.failed += 1
+                    continue
+                size, mtime = stat.st_size, stat.st_mtime_ns
+
+            if previous is not None and previous[:2] == (size, mtime):
+                self.report['unchanged'] += 1
+                self.job.skipped += 1
+                continue
+
+            # check if the file is already in the database:
+            if previous is None and filename in self.known:
+                logging.info(f'media {filename} already in the database, skipping.')
+                self.manifest_updates.append((filename, size, mtime, False))
+                self.report['unchanged'] += 1
+                self.job.skipped += 1
+                continue
+
+            self.report['new' if previous is None else 'changed'] += 1
+            if previous is not None:
+                self.changed.add(filename)
+            self.candidates[filename] = (size, mtime)
+            return filename
+
+        return None
+
+    def process(self, filename, future):
+        """
+        Accounts for the outcome of import_media_file() on @filename and
+        returns its record, or None if the file was not imported.
+        """
+
+        # files that fail are recorded too, so that they are only retried
+        # once they change:
+        self.manifest_updates.append((filename, *self.candidates.pop(filename), False))
+
+        try:
+            record = future.result()
+        except Exception as e:
+            logging.warning(f'failed to import {filename}: {e!r}')
+            self.job.failed += 1
+            return None
+
+        if record is None:
+            self.job.skipped += 1
+            return None
+
+        method = record['thumbnail_method']
+        self.report['thumbnails'][method] = self.report['thumbnails'].get(method, 0) + 1
+        record['changed'] = filename in self.changed
+        return record
+
+    def finish(self):
+        """
+        Writes the manifest updates of the directory. Deletions are only
+        known once the whole tree has been scanned, and they are only
+        reported unless config.IMPORT_REMOVE_DELETED is set.
+        """
+
+        self.db.update_manifest(self.manifest_updates)
+
+        if self.complete:
+            deleted = [entry for entry in self.manifest if entry not in self.seen]
+            for entry in deleted:
+                logging.info(f'{entry} has been removed from {self.path}.')
+            self.report['deleted'] = [entry for entry in deleted if not self.manifest[entry][2]]
+            self.db.remove_from_manifest(deleted)
+
+            # media imported in place are gone with their files; copies in
+            # the album outlive their originals. A tree that comes up empty
+            # is more likely an unmounted volume than an emptied one:
+            if config.IMPORT_IN_PLACE and config.IMPORT_REMOVE_DELETED and len(self.report['deleted']) > 0:
+                if self.files == 0:
+                    logging.warning(f'no files found in {self.path}, keeping the media of its {len(self.report["deleted"])} deleted files.')
+                else:
+                    self.db.remove_media_files(self.report['deleted'])
+
 class MedievalDB:
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, backend=None, **kwargs):
+        """
+        @backend: storage backend (default: the one selected by
+                  config.DB_BACKEND)
+        """
+
+        self.backend = create_backend() if backend is None else backend
+        self.local = threading.local()
+        self.pool = ConnectionPool(lambda: Connection(self.backend), size=config.DB_POOL_SIZE, timeout=config.DB_POOL_TIMEOUT, check=lambda connection: connection.ping(), check_after=config.DB_POOL_CHECK_AFTER)
+
+        # open the first connection right away so that a misconfigured
+        # database is reported at startup:
         try:
-            db = mdb.connect(**dbconfig)
-            self.cursor = db.cursor(dictionary=True) # for mariadb module
-            db.autocommit = True
-        except mdb.Error as e:
+            with self.connection():
+                pass
+        except self.backend.Error as e:
             logging.critical(f'error connecting to the database: {e}')
             exit(1)
 
         if not os.path.exists(config.THUMBNAIL_DIR):
             os.makedirs(config.THUMBNAIL_DIR, mode=0o755, exist_ok=True)
 
+        self.migrate()
+
+        self.previews = PreviewCache()
+        self.renditions = RenditionCache()
+        self.video_thumbnailer = VideoThumbnailer()
+        # number of imports whose workers are writing previews (see
+        # collect_preview_garbage()):
+        self.imports = 0
+        self.imports_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Borrows a connection from the pool for the duration of the `with`
+        block and yields a dictionary cursor on it. The call is re-entrant:
+        nested blocks in the same thread share the connection, so methods
+        can freely call each other without holding more than one
+        connection per thread.
+        """
+
+        depth = getattr(self.local, 'depth', 0)
+        if depth == 0:
+            self.local.connection = self.pool.acquire()
+        self.local.depth = depth + 1
+
+        broken = False
+        try:
+            cursor = self.local.connection.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+        except self.backend.Error:
+            # most errors (a constraint, a typo) leave the connection usable;
+            # one that has gone away is not returned to the pool:
+            try:
+                self.local.connection.ping()
+            except Exception:
+                broken = True
+            raise
+        finally:
+            self.local.depth -= 1
+            if self.local.depth == 0:
+                connection, self.local.connection = self.local.connection, None
+                if broken:
+                    self.pool.discard(connection)
+                else:
+                    self.pool.release(connection)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Like connection(), but runs the block in a transaction that is
+        committed when the block completes and rolled back if it raises.
+        A transaction nested in another one joins the outer transaction.
+        """
+
+        with self.connection() as cursor:
+            if getattr(self.local, 'transaction', False):
+                yield cursor
+                return
+
+            self.local.transaction = True
+            self.backend.begin(self.local.connection.db)
+            try:
+                yield cursor
+                self.local.connection.db.commit()
+            except BaseException:
+                self.local.connection.db.rollback()
+                raise
+            finally:
+                self.local.transaction = False
+
+    def execute(self, statement, params=()):
+        """
+        @statement: parameterized SQL statement
+        @params: statement parameters
+
+        Executes @statement on the connection of the enclosing connection()
+        or transaction() block, through a cursor on which it is prepared
+        once per connection, and returns that cursor. Results have to be
+        fetched before the same statement is executed again.
+        """
+
+        return self.local.connection.execute(statement, params)
+
+    def pool_statistics(self):
+        return self.pool.statistics()
+
     def create_empty_database(self, overwrite=False):
         """
         @overwrite: delete existing database entries (default: False)
@@ -62,305 +921,2297 @@ class MedievalDB:
         any previous database entries.
         """
 
-        if overwrite:
-            self.cursor.execute('drop table if exists albums_in_collections')
-            self.cursor.execute('drop table if exists media_in_albums')
-            self.cursor.execute('drop table if exists media')
-            self.cursor.execute('drop table if exists collections')
-            self.cursor.execute('drop table if exists albums')
-        
-        self.cursor.execute('create table media (id int unsigned not null auto_increment primary key, filename varchar(256) not null, thumbnail varchar(32) not null, mimetype varchar(32), timestamp datetime, width smallint unsigned, height smallint unsigned, orientation tinyint, make varchar(32), model varchar(32), description varchar(1024))')
-        self.cursor.execute('create table collections (id int unsigned not null auto_increment, name varchar(16) not null, password char(64) default NULL, primary key(id))')
-        self.cursor.execute('create table albums (id int unsigned not null auto_increment, name varchar(100) not null, password char(64) default NULL, primary key(id))')
-        self.cursor.execute('create table media_in_albums (album_id int unsigned not null, media_id int unsigned not null, foreign key (album_id) references albums(id), foreign key (media_id) references media(id), unique (album_id, media_id))')
-        self.cursor.execute('create table albums_in_collections (collection_id int unsigned not null, album_id int unsigned not null, foreign key (collection_id) references collections(id), foreign key (album_id) references albums(id), unique (collection_id, album_id))')
+        with self.connection() as cursor:
+            if overwrite:
+                cursor.execute('drop table if exists schema_version')
+                cursor.execute('drop table if exists manifest')
+                cursor.execute('drop table if exists media_metadata')
+                cursor.execute('drop table if exists albums_in_collections')
+                cursor.execute('drop table if exists media_in_albums')
+                cursor.execute('drop table if exists media')
+                cursor.execute('drop table if exists collections')
+                cursor.execute('drop table if exists albums')
 
-    def generate_thumbnail(self, filename, image):
-        thname = ''.join(random.choices(string.ascii_lowercase + string.digits, k=16))
-        image.thumbnail((256, 256), Image.ANTIALIAS)
-        oriented_image = ImageOps.exif_transpose(image)
-        oriented_image.save(config.THUMBNAIL_DIR + f'/{thname}.jpg')
+            self.migrate()
+
+    def schema_version(self):
+        with self.connection() as cursor:
+            cursor.execute('create table if not exists schema_version (version int unsigned not null)')
+            cursor.execute('select max(version) as version from schema_version')
+            version = cursor.fetchall()[0]['version']
+            return 0 if version is None else version
+
+    def migrate(self):
+        """
+        Brings the database schema up to date by applying, in order, all
+        migrations newer than the recorded schema version. Existing
+        libraries are upgraded in place, without re-importing. Returns the
+        resulting schema version.
+        """
+
+        version = self.schema_version()
+        with self.connection() as cursor:
+            for target, statements in self.backend.migrations:
+                if target <= version:
+                    continue
 
-        return thname
+                logging.info(f'migrating the database schema to version {target}.')
+                for statement in statements:
+                    if callable(statement):
+                        statement(cursor)
+                    else:
+                        cursor.execute(statement)
+
+                # DDL statements commit implicitly, so each migration is recorded
+                # as soon as it has been applied:
+                cursor.execute('insert into schema_version (version) values (?)', (target,))
+                version = target
+
+            return version
+
+    def generate_thumbnail(self, filename, image):
+        return generate_thumbnail(filename, image)[0]
 
     def generate_video_thumbnail(self, filename, width, height, duration):
-        thname = ''.join(random.choices(string.ascii_lowercase + string.digits, k=16))
-        xsize = 256 if width >= height else -1
-        ysize = -1 if width >= height else 256
-        
-        capture = ffmpeg.input(filename, ss=duration // 2).filter('scale', xsize, ysize).output(config.THUMBNAIL_DIR + f'/{thname}.jpg', vframes=1).overwrite_output().run(capture_stdout=True, capture_stderr=True)
-        return thname
+        return generate_video_thumbnail(filename, width, height, duration)
 
     def get_video_timestamp(self, metadata):
+        return get_video_timestamp(metadata)
+
+    def media_in_database(self, filename):
+        with self.connection() as cursor:
+            cursor.execute('select id from media where filename=? limit 1', (filename,))
+            entries = cursor.fetchall()
+            return False if len(entries) == 0 else True
+
+    def known_media(self, path):
         """
-        Alas, there seems to be no clear standard for including timestamps in
-        the videos. Here we try several common options in the hope that
-        something will work.
+        @path: directory
+
+        Returns the set of filenames under @path that are already in the
+        database. This is a single range scan over the unique filename index,
+        so importers can test membership in memory instead of querying the
+        database for every file.
         """
 
-        # regex rules:
-        regex_rules = [r'\d{8}.\d{6}', r'\d{8}']
+        with self.connection() as cursor:
+            cursor.execute(f'select filename from media where filename {self.backend.prefix_match}', (self.backend.prefix_pattern(path),))
+            return {entry['filename'] for entry in cursor.fetchall()}
 
-        # try creation time:
-        tags = metadata['format'].get('tags', None)
-        if tags:
-            ct = metadata['format']['tags'].get('creation_time', None)
-            if ct:
-                iso = parser.parse(ct)
-                return f'{iso.date()} {iso.time()}'
+    def load_manifest(self, path):
+        """
+        @path: directory
 
-        # try the filename:
-        filename = metadata['format'].get('filename', None)
-        if filename:
-            for rule in regex_rules:
-                match = re.search(rule, filename)
-                if match is None:
-                    continue
-                print(match.start(), match.end())
-                iso = parser.parse(filename[match.start():match.end()].replace('_', '-'))
-                return f'{iso.date()} {iso.time()}'
+        Returns the import manifest for @path and everything below it as a
+        dictionary {path: (size, mtime, is_dir)}, with mtime in nanoseconds.
+        """
 
-        return 'NULL'
+        path = os.path.abspath(path)
+        with self.connection() as cursor:
+            cursor.execute(f'select path, size, mtime, is_dir from manifest where path=? or path {self.backend.prefix_match}', (path, self.backend.prefix_pattern(path)))
+            return {entry['path']: (entry['size'], entry['mtime'], bool(entry['is_dir'])) for entry in cursor.fetchall()}
 
-    def media_in_database(self, filename):
-        self.cursor.execute(f'select * from media where filename="{filename}"')
-        entries = self.cursor.fetchall()
-        return False if len(entries) == 0 else True
+    def update_manifest(self, entries):
+        """
+        @entries: list of (path, size, mtime, is_dir) tuples
 
-    def import_media_from_directory(self, path):
-        media_ids = []
+        Inserts or refreshes manifest @entries in a single transaction.
+        """
 
-        files = os.listdir(path)
-        for file in files:
-            filename = os.path.abspath(path+'/'+file)
+        if len(entries) == 0:
+            return
 
-            # check if the file is already in the database:
-            if self.media_in_database(filename):
-                logging.info(f'media {filename} already in the database, skipping.')
-                continue
+        with self.transaction() as cursor:
+            cursor.executemany(self.backend.upsert('manifest', ('path', 'size', 'mtime', 'is_dir'), key='path', update=('size', 'mtime', 'is_dir')), entries)
 
-            mimetype = mimetypes.guess_type(filename)[0]
-            if mimetype is None:
-                logging.info(f'file {filename} has no identifiable mime type, skipping.')
-                continue
+    def remove_from_manifest(self, paths):
+        if len(paths) == 0:
+            return
 
-            if 'image' in mimetype:
-                try:
-                    im = Image.open(filename)
-                    exif = import_exif(im)
-                except:
-                    logging.info(f'failed to import {filename}, skipping.')
-                    continue
+        with self.transaction() as cursor:
+            cursor.executemany('delete from manifest where path=?', [(path,) for path in paths])
 
-                timestamp = exif.get('DateTimeOriginal', 'NULL')
-                width = exif.get('ExifImageWidth', im.size[0])
-                height = exif.get('ExifImageHeight', im.size[1])
-                orientation = exif.get('Orientation', -1)
-                make = exif.get('Make', '')
-                model = exif.get('Model', '')
+    def import_media_from_directory(self, path, workers=None, chunk_size=None, thorough=None, report=None, job=None):
+        """
+        @path: directory to import media from
+        @workers: number of worker processes (default: config.IMPORT_WORKERS)
+        @chunk_size: number of records per database transaction (default:
+                     config.IMPORT_CHUNK_SIZE)
+        @thorough: stat every file, even in directories that have not changed
+                   since the last import, to catch files rewritten in place
+                   (default: config.IMPORT_THOROUGH)
+        @report: optional dictionary that is filled with the number of 'new',
+                 'changed' and 'unchanged' files, the list of 'deleted'
+                 files and the number of 'thumbnails' generated by each
+                 method (see generate_previews())
+        @job: ImportJob that follows the progress of the import, receives
+              the committed rows and can cancel it (default: none)
 
-                thumbnail = self.generate_thumbnail(filename, im)
+        Imports all media from @path and its subdirectories; see
+        import_media_from_directories(). Returns the imported rows ordered
+        by timestamp.
+        """
 
-                if not config.IMPORT_IN_PLACE:
-                    try:
-                        ts = timestamp.split(' ')[0].replace(':', '-')
-                    except:
-                        ts = 'NULL'
-                    os.makedirs(config.ALBUM_DIR + f'/{ts}/', mode=0o755, exist_ok=True)
-                    shutil.copy2(filename, config.ALBUM_DIR + f'/{ts}/' + os.path.basename(filename))
-                    filename = config.ALBUM_DIR + f'/{ts}/' + os.path.basename(filename)
-
-                media_id = self.add_media(
-                    filename=filename,
-                    thumbnail=thumbnail,
-                    mimetype=mimetype,
-                    timestamp=timestamp,
-                    width=width,
-                    height=height,
-                    orientation=orientation,
-                    make=make,
-                    model=model,
-                    description=None
-                )
-                media_ids.append(media_id)
-            
-            elif 'video' in mimetype:
-                try:
-                    meta = ffmpeg.probe(filename)
-                    format = meta['format']
-                    streams = meta['streams']
-                    for stream in streams:
-                        if stream['codec_type'] == 'video':
-                            break
-                except:
-                    logging.info(f'failed to import {filename}, skipping.')
-                    continue
+        reports = {}
+        media_ids = self.import_media_from_directories([path], workers=workers, chunk_size=chunk_size, thorough=thorough, reports=reports, job=job)
+        if report is not None:
+            report.update(next(iter(reports.values())))
+        return self.query_media_by_ids(media_ids)
 
-                width = int(stream['width'])
-                height = int(stream['height'])
-                duration = float(format['duration'])
-                timestamp = self.get_video_timestamp(meta)
+    def import_media_from_directories(self, paths, workers=None, chunk_size=None, thorough=None, reports=None, job=None, device_concurrency=None):
+        """
+        @paths: list of directories to import media from
+        @workers: number of worker processes shared by all directories
+                  (default: config.IMPORT_WORKERS)
+        @chunk_size: number of records per database transaction (default:
+                     config.IMPORT_CHUNK_SIZE)
+        @thorough: stat every file, even in directories that have not changed
+                   since the last import, to catch files rewritten in place
+                   (default: config.IMPORT_THOROUGH)
+        @reports: optional dictionary that is filled with a report per
+                  directory (see import_media_from_directory())
+        @job: ImportJob that follows the progress of the import, receives
+              the committed rows and can cancel it (default: none)
+        @device_concurrency: maximum number of files per source device that
+                             are in flight at once (default:
+                             config.IMPORT_DEVICE_CONCURRENCY)
 
-                thumbnail = self.generate_video_thumbnail(filename, width, height, duration)
+        Imports all media from @paths and their subdirectories. Each
+        directory is walked by scan_directory() in its own thread and
+        compared against the manifest of its previous import, so only new or
+        changed files are processed. Unless the import is @thorough, files
+        in directories that have not changed since the previous import are
+        taken as unchanged too (see scan_directory()). A changed file
+        replaces the media row and the previews of its previous version.
+        Files that disappeared are reported and dropped from the manifest,
+        once a scan has read its whole tree; their media stay in the
+        library unless config.IMPORT_REMOVE_DELETED is set (see
+        ImportSource.finish()). An import that completes collects the
+        orphaned previews (see collect_preview_garbage()).
+        Directories nested in another one of @paths are imported as part of
+        it.
 
-                if not config.IMPORT_IN_PLACE:
-                    try:
-                        ts = timestamp.split(' ')[0].replace(':', '-')
-                    except:
-                        ts = 'NULL'
-
-                    os.makedirs(config.ALBUM_DIR + f'/{ts}/', mode=0o755, exist_ok=True)
-                    shutil.copy2(filename, config.ALBUM_DIR + f'/{ts}/' + os.path.basename(filename))
-                    filename = config.ALBUM_DIR + f'/{ts}/' + os.path.basename(filename)
-
-                media_id = self.add_media(
-                    filename=filename,
-                    thumbnail=thumbnail,
-                    mimetype=mimetype,
-                    timestamp=timestamp,
-                    width=width,
-                    height=height,
-                    orientation=-1,
-                    make='',
-                    model='',
-                    description=None
-                )
-                media_ids.append(media_id)
+        Decoding, EXIF parsing and thumbnailing run in a single pool of
+        worker processes (see import_media_file()), fed while the scans are
+        still running. The directories take turns to submit files, and no
+        source device has more than @device_concurrency files in flight, so
+        a slow card neither holds up the scan of a fast disk nor fills the
+        pool with files that wait for it. This process is the single writer
+        that commits the rows to the database in chunks of @chunk_size;
+        the rows of every chunk are handed to @job as they commit. Returns
+        the ids of the imported media.
 
-            else:
-                logging.warning(f'mimetype={mimetype} not recognized as a media format, skipping.')
-                continue
+        A cancelled import stops once the files that are being processed
+        are committed. Files it did not get to are not recorded in the
+        manifest, so the next import picks them up.
+        """
 
-        if len(media_ids) == 0:
-            return []
-        else:
-            self.cursor.execute(f'select * from media where id in {tuple(media_ids)} order by timestamp asc')
-            return self.cursor.fetchall()
+        if job is None:
+            job = ImportJob(paths)
+        if job.started is None:
+            job.started = time.perf_counter()
 
-    def add_media(self, filename, thumbnail, mimetype, timestamp='NULL', width=None, height=None, orientation=None, make=None, model=None, description=None):
-        if timestamp != 'NULL':
-            timestamp = f'"{timestamp}"'
-        self.cursor.execute(f'insert into media (filename,thumbnail,mimetype,timestamp,width,height,orientation,make,model,description) values ("{os.path.abspath(filename)}","{thumbnail}","{mimetype}",{timestamp},{width},{height},{orientation},"{make}","{model}","{description}")')
-        return self.cursor.lastrowid
+        if workers is None:
+            workers = config.IMPORT_WORKERS
+        if chunk_size is None:
+            chunk_size = config.IMPORT_CHUNK_SIZE
+        if device_concurrency is None:
+            device_concurrency = config.IMPORT_DEVICE_CONCURRENCY
+        if thorough is None:
+            thorough = config.IMPORT_THOROUGH
 
-    def update_media(self, media_id, **kwargs):
-        for k, v in kwargs.items():
-            print(f'k={k}, v={v}, media_id={media_id}')
-            self.cursor.execute(f'update media set {k}="{v}" where id={media_id}')
+        paths = list(dict.fromkeys(os.path.abspath(path) for path in paths))
+        paths = [path for path in paths if not any(path.startswith(other+os.sep) for other in paths if other != path)]
+        ready = threading.Event()
+        sources = [ImportSource(self, path, thorough, job, ready) for path in paths]
 
-    def remove_media(self, media_id):
-        self.cursor.execute(f'delete from media where id={media_id}')
+        media_ids = []
+        records = []
+        video_jobs = []
 
-    def add_album(self, name, password=None):
-        if password is not None:
-            self.cursor.execute(f'insert into albums (name,password) values ("{name}", SHA2("{password}",256))')
-        else:
-            self.cursor.execute(f'insert into albums (name) values ("{name}")')
-        return self.cursor.lastrowid
+        def commit(records):
+            # a changed file replaces the row of its previous version, whose
+            # previews are dropped once nothing else uses them:
+            replaced = self.media_thumbnails([record['filename'] for record in records if record['changed']])
+            ids = self.add_media_batch(records)
+            self.remove_unused_previews(replaced - {record['thumbnail'] for record in records})
+            self.previews.register([record['thumbnail'] for record in records])
+            job.imported += len(ids)
+            if job.on_batch is not None:
+                job.add_batch(self.query_media_by_ids(ids))
+            return ids
 
-    def update_album(self, album_id, **kwargs):
-        changes = ','.join([f'{k}="{kwargs[k]}"' if kwargs[k] is not None else f'{k}=NULL' for k in kwargs])
-        # password needs a specialized treatment:
-        
-        if 'password' in kwargs and kwargs['password'] is not None:
-            changes = changes.replace(f'"{kwargs["password"]}"', f'SHA2("{kwargs["password"]}",256)')
+        # only a few files per worker are in flight at any time, so the
+        # workers start on the first files while the scans go on, and a
+        # cancellation only waits for the files already submitted:
+        window = 4*(workers or os.cpu_count() or 1)
+        futures = {}
+        in_flight = collections.Counter()
+        turns = collections.deque(sources)
 
-        self.cursor.execute(f'update albums set {changes} where id={album_id}')
+        def submit(pool):
+            # round robin over the directories; a directory is passed over
+            # when its scan has nothing new yet or its device is busy:
+            devices = {source.device for source in turns} | {device for device in in_flight if in_flight[device] > 0}
+            limit = device_concurrency or -(-window//max(len(devices), 1))
 
-    def add_collection(self, name, password=None):
-        if password is not None:
-            self.cursor.execute(f'insert into collections (name,password) values ("{name}", SHA2("{password}",256))')
-        else:
-            self.cursor.execute(f'insert into collections (name) values ("{name}")')
-        return self.cursor.lastrowid
+            passed = 0
+            while len(futures) < window and passed < len(turns) and not job.cancelled:
+                source = turns[0]
+                turns.rotate(-1)
 
-    def add_media_to_album(self, media_id, album_id):
-        self.cursor.execute(f'insert into media_in_albums (album_id,media_id) values ({album_id},{media_id})')
+                filename = None
+                if in_flight[source.device] < limit:
+                    filename = source.next_candidate()
 
-    def remove_media_from_album(self, media_id, album_id):
-        self.cursor.execute(f'delete from media_in_albums where media_id={media_id} and album_id={album_id}')
+                if source.exhausted:
+                    turns.remove(source)
+                    passed = 0
+                    continue
+                if filename is None:
+                    passed += 1
+                    continue
 
-    def add_album_to_collection(self, album_id, collection_id):
-        self.cursor.execute(f'insert into albums_in_collections (collection_id,album_id) values ({collection_id},{album_id})')
+                passed = 0
+                # only media are copied; import_media_file() skips the rest:
+                mimetype = mimetypes.guess_type(filename)[0] or ''
+                if copier is not None and ('image' in mimetype or 'video' in mimetype):
+                    futures[copier.submit(stage_media_file, filename)] = (source, filename, 'copy', None)
+                else:
+                    futures[pool.submit(import_media_file, filename)] = (source, filename, 'decode', None)
+                in_flight[source.device] += 1
 
-    def query_media(self, album_id=None, password=None):
-        if album_id is None:
-            self.cursor.execute(f'select * from media order by timestamp asc')
-            return self.cursor.fetchall()
+        # unless media are imported in place, a pool of threads copies them
+        # into the album ahead of the workers, which then decode the copies
+        # while they are in the page cache:
+        copier = None
+        if not config.IMPORT_IN_PLACE:
+            copier = ThreadPoolExecutor(max_workers=config.IMPORT_COPY_WORKERS, thread_name_prefix='import-copy')
 
-        if password is None:
-            self.cursor.execute(f'select * from media where id in (select media_id from media_in_albums where album_id in (select id from albums where id={album_id} and password is NULL))')
-        else:
-            self.cursor.execute(f'select * from media where id in (select media_id from media_in_albums where album_id in (select id from albums where id={album_id} and password=sha2("{password}", 256)))')
-        return self.cursor.fetchall()
+        for source in sources:
+            source.start()
 
-    def set_album_password(self, album_id, password):
-        self.cursor.execute(f'update albums set password=sha2("{password}", 256) where id={album_id}')
+        with self.imports_lock:
+            self.imports += 1
+        try:
+            # the import runs next to other threads (the GUI, the loaders,
+            # the scans), which a forked worker could inherit holding a
+            # lock; workers start from a clean server process instead:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver')) as pool:
+                while True:
+                    # cleared before the queues are drained, so an entry
+                    # queued from here on wakes up the wait below:
+                    ready.clear()
+                    submit(pool)
+                    if len(futures) == 0:
+                        if len(turns) == 0 or job.cancelled:
+                            break
+                        # nothing in flight: sleep until a scan finds
+                        # something (or check for a cancellation now and
+                        # then):
+                        ready.wait(0.25)
+                        continue
 
-    def unset_album_password(self, album_id):
-        self.cursor.execute(f'update albums set password=NULL where id={album_id}')
+                    # while scans are running, wake up regularly to pick up
+                    # the files they have found:
+                    done, not_done = concurrent.futures.wait(futures, timeout=0.05 if len(turns) > 0 else None, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        source, filename, stage, staged = futures.pop(future)
 
-    def validate_album_password(self, album_id=None, password=None):
-        self.cursor.execute(f'select id from albums where id={album_id} and password=sha2("{password}", 256)')
-        res = self.cursor.fetchall()
-        if len(res) == 0:
-            return False
-        return res[0]['id'] == album_id
+                        # a copied file keeps its place in the window until
+                        # it is decoded:
+                        if stage == 'copy' and future.exception() is None:
+                            staged, key = future.result()
+                            futures[pool.submit(import_media_file, filename, key=key, staged=staged)] = (source, filename, 'decode', staged)
+                            continue
 
-    def delete_album(self, album_id):
-        self.cursor.execute(f'delete from media_in_albums where album_id={album_id}')
-        self.cursor.execute(f'delete from albums where id={album_id}')
+                        in_flight[source.device] -= 1
+                        record = source.process(filename, future)
+                        if record is None:
+                            if staged is not None and os.path.exists(staged):
+                                os.remove(staged)
+                            continue
 
-    def query_albums(self):
-        self.cursor.execute(f'select id,name,password is not null as locked from albums order by name asc')
-        return self.cursor.fetchall()
+                        # video thumbnails are extracted in their own pool so
+                        # that they don't hold up the images:
+                        if record['video'] is not None and not os.path.exists(preview_path(record['thumbnail'])):
+                            video_jobs.append((record, self.video_thumbnailer.submit(record['filename'], key=record['thumbnail'], **record['video'])))
 
-    def query_collections(self):
-        self.cursor.execute(f'select id,name from collections order by name asc')
-        return self.cursor.fetchall()
+                        records.append(record)
+                        if len(records) >= chunk_size:
+                            media_ids += commit(records)
+                            records = []
 
-def import_exif(image, taglist=ExifTags.TAGS):
-    tags = dict()
-    exif = image.getexif()
-    for tag_id in exif:
-        tag = taglist.get(tag_id, tag_id)
-        val = exif.get(tag_id)
-        if type(val) == str:
-            val = val.replace('\x00', '').strip()
-        tags[tag] = val
-    return tags
+                    job.report_progress()
+
+            if len(records) > 0:
+                media_ids += commit(records)
+        finally:
+            with self.imports_lock:
+                self.imports -= 1
+            if copier is not None:
+                copier.shutdown()
+            for source in sources:
+                source.stop()
+
+        # the rows are already committed; a video whose thumbnail fails or
+        # is cancelled here gets it regenerated on demand by the preview
+        # cache. A cancellation only stops the jobs of this import:
+        pending = {video_job for record, video_job in video_jobs}
+        while len(pending) > 0:
+            if job.cancelled:
+                self.video_thumbnailer.cancel(pending)
+            done, pending = concurrent.futures.wait(pending, timeout=0.25)
+        for record, video_job in video_jobs:
+            if video_job.cancelled():
+                continue
+            try:
+                video_job.result()
+            except Exception as e:
+                if not job.cancelled:
+                    logging.warning(f'failed to generate the thumbnail of {record["filename"]}: {e!r}')
+        self.previews.register([record['thumbnail'] for record, video_job in video_jobs])
+
+        for source in sources:
+            source.finish()
+            if reports is not None:
+                reports[source.path] = source.report
+
+        if not job.cancelled:
+            self.collect_preview_garbage()
+
+        return media_ids
+
+    def query_media_by_ids(self, media_ids, chunk_size=1000):
+        """
+        @media_ids: list of media ids
+        @chunk_size: number of ids per statement, well below the placeholder
+                     limits of both backends
+
+        Returns the media entries of @media_ids, ordered by timestamp (NULL
+        first, as the database orders them) and id.
+        """
+
+        entries = []
+        with self.connection() as cursor:
+            for start in range(0, len(media_ids), chunk_size):
+                chunk = tuple(media_ids[start:start+chunk_size])
+                cursor.execute(f'select * from media where id in ({",".join("?"*len(chunk))})', chunk)
+                entries += cursor.fetchall()
+
+        entries.sort(key=lambda entry: (entry['timestamp'] is not None, entry['timestamp'] or 0, entry['id']))
+        return entries
+
+    def add_media(self, filename, thumbnail, mimetype, timestamp='NULL', width=None, height=None, orientation=None, make=None, model=None, description=None):
+        return self.add_media_batch([{
+            'filename': filename,
+            'thumbnail': thumbnail,
+            'mimetype': mimetype,
+            'timestamp': timestamp,
+            'width': width,
+            'height': height,
+            'orientation': orientation,
+            'make': make,
+            'model': model,
+            'description': description,
+        }])[0]
+
+    def add_media_batch(self, records):
+        """
+        @records: list of dictionaries with add_media() arguments
+
+        Inserts all @records in a single transaction with one parameterized
+        executemany() call. Returns the list of media ids in the order of
+        @records.
+        """
+
+        if len(records) == 0:
+            return []
+
+        rows = []
+        for record in records:
+            rows.append((
+                os.path.abspath(record['filename']),
+                record['thumbnail'],
+                record['mimetype'],
+                parse_timestamp(record.get('timestamp', None)),
+                record.get('width', None),
+                record.get('height', None),
+                record.get('orientation', None),
+                record.get('make', None),
+                record.get('model', None),
+                record.get('description', None),
+            ))
+
+        with self.transaction() as cursor:
+            # re-imported (changed) files keep their id and description:
+            cursor.executemany(self.backend.upsert('media', ('filename', 'thumbnail', 'mimetype', 'timestamp', 'width', 'height', 'orientation', 'make', 'model', 'description'), key='filename', update=('thumbnail', 'mimetype', 'timestamp', 'width', 'height', 'orientation', 'make', 'model')), rows)
+
+            # bulk inserts do not report per-row ids, so look them up by the
+            # (unique) filename:
+            filenames = [row[0] for row in rows]
+            cursor.execute(f'select id, filename from media where filename in ({",".join("?"*len(filenames))})', filenames)
+            ids = {entry['filename']: entry['id'] for entry in cursor.fetchall()}
+
+            metadata = [(ids[filename], json.dumps(record['metadata'], default=str)) for filename, record in zip(filenames, records) if record.get('metadata', None) is not None]
+            if len(metadata) > 0:
+                cursor.executemany(self.backend.upsert('media_metadata', ('media_id', 'metadata'), key='media_id', update=('metadata',)), metadata)
+
+        return [ids[filename] for filename in filenames]
+
+    def query_media_by_id(self, media_id):
+        """
+        Returns the media entry of @media_id, or None if there is none.
+        """
+
+        with self.connection():
+            entries = self.execute('select * from media where id=?', (media_id,)).fetchall()
+            return entries[0] if len(entries) > 0 else None
+
+    def query_media_metadata(self, media_id):
+        """
+        Returns the metadata stored for @media_id on import, or None if there
+        is none (for example for media imported before metadata was stored).
+        """
+
+        with self.connection():
+            entries = self.execute('select metadata from media_metadata where media_id=?', (media_id,)).fetchall()
+            if len(entries) == 0:
+                return None
+            return json.loads(entries[0]['metadata'])
+
+    def refresh_media_metadata(self, media_id):
+        """
+        Re-reads the metadata of @media_id from the media file and stores it.
+        Use this when the file has changed, or to backfill media imported
+        before metadata was stored. Returns the new metadata.
+        """
+
+        with self.connection() as cursor:
+            cursor.execute('select filename, mimetype from media where id=?', (media_id,))
+            entry = cursor.fetchall()[0]
+
+        # the file is read without holding on to a pooled connection:
+        if 'image' in entry['mimetype']:
+            with Image.open(entry['filename']) as im:
+                metadata = exif_metadata(im)
+        elif 'video' in entry['mimetype']:
+            metadata = video_metadata(ffmpeg.probe(entry['filename']))
+        else:
+            raise ValueError(f'mimetype {entry["mimetype"]} not recognized.')
+
+        with self.connection() as cursor:
+            cursor.execute(self.backend.upsert('media_metadata', ('media_id', 'metadata'), key='media_id', update=('metadata',)), (media_id, json.dumps(metadata, default=str)))
+        return metadata
+
+    def update_media(self, media_id, **kwargs):
+        for column in kwargs:
+            if column not in media_columns or column == 'id':
+                raise ValueError(f'column={column} is not an editable media column.')
+
+        with self.connection():
+            for column, value in kwargs.items():
+                self.execute(f'update media set {column}=? where id=?', (value, media_id))
+
+    def remove_media(self, media_id):
+        with self.transaction():
+            entries = self.execute('select thumbnail from media where id=?', (media_id,)).fetchall()
+            self.execute('delete from media_in_albums where media_id=?', (media_id,))
+            self.execute('delete from media where id=?', (media_id,))
+            self.remove_unused_previews({entry['thumbnail'] for entry in entries})
+            self.renditions.remove(media_id)
+
+    def remove_media_files(self, filenames):
+        """
+        Removes the media of @filenames from the library, if they are in it.
+        """
+
+        for filename in filenames:
+            with self.connection():
+                entries = self.execute('select id from media where filename=?', (filename,)).fetchall()
+            for entry in entries:
+                self.remove_media(entry['id'])
+
+    def media_thumbnails(self, filenames):
+        """
+        Returns the set of preview keys of the media of @filenames.
+        """
+
+        keys = set()
+        with self.connection():
+            for filename in filenames:
+                keys.update(entry['thumbnail'] for entry in self.execute('select thumbnail from media where filename=?', (filename,)).fetchall())
+        return keys
+
+    def remove_unused_previews(self, keys):
+        """
+        Removes the previews of @keys that no longer belong to any media;
+        previews are content-addressed, so they may be shared by duplicates.
+        """
+
+        with self.connection():
+            for key in keys:
+                if len(self.execute('select id from media where thumbnail=? limit 1', (key,)).fetchall()) == 0:
+                    self.previews.remove(key)
+
+    def collect_preview_garbage(self):
+        """
+        Removes all cached previews that no longer belong to any media, for
+        example those of rows deleted outside remove_media(). Import workers
+        write previews before their rows are committed, so nothing is
+        collected while an import is running, and an import waits for a
+        collection to end before it starts. Returns the number of removed
+        previews, or None if an import was running.
+
+        The whole preview directory is scanned on first use, so this is
+        called off the main loop: at startup and after every import.
+        """
+
+        with self.imports_lock:
+            if self.imports > 0:
+                logging.info('an import is running, orphaned previews are left for later.')
+                return None
+
+            with self.connection() as cursor:
+                cursor.execute('select distinct thumbnail from media')
+                return self.previews.collect_garbage({entry['thumbnail'] for entry in cursor.fetchall()})
+
+    def add_album(self, name, password=None):
+        with self.connection():
+            if password is not None:
+                return self.execute('insert into albums (name,password) values (?,sha2(?,256))', (name, password)).lastrowid
+            else:
+                return self.execute('insert into albums (name) values (?)', (name,)).lastrowid
+
+    def update_album(self, album_id, **kwargs):
+        changes, params = [], []
+        for column, value in kwargs.items():
+            if column not in ('name', 'password'):
+                raise ValueError(f'column={column} is not an editable album column.')
+            # password needs a specialized treatment:
+            changes.append(f'{column}=sha2(?,256)' if column == 'password' and value is not None else f'{column}=?')
+            params.append(value)
+
+        with self.connection():
+            self.execute(f'update albums set {",".join(changes)} where id=?', (*params, album_id))
+
+    def add_collection(self, name, password=None):
+        with self.connection():
+            if password is not None:
+                return self.execute('insert into collections (name,password) values (?,sha2(?,256))', (name, password)).lastrowid
+            else:
+                return self.execute('insert into collections (name) values (?)', (name,)).lastrowid
+
+    def add_media_to_album(self, media_id, album_id):
+        with self.connection():
+            self.execute('insert into media_in_albums (album_id,media_id) values (?,?)', (album_id, media_id))
+
+    def remove_media_from_album(self, media_id, album_id):
+        with self.connection():
+            self.execute('delete from media_in_albums where media_id=? and album_id=?', (media_id, album_id))
+
+    def add_album_to_collection(self, album_id, collection_id):
+        with self.connection():
+            self.execute('insert into albums_in_collections (collection_id,album_id) values (?,?)', (collection_id, album_id))
+
+    def query_media(self, album_id=None, password=None):
+        """
+        @album_id: album to list (default: the whole library)
+        @password: album password, if the album is locked
+
+        Returns the media in the library, ordered by timestamp and id, or in
+        album @album_id. A locked album is listed only with the right
+        @password, and an unlocked one only without a password.
+        """
+
+        with self.connection():
+            if album_id is None:
+                return self.execute('select * from media order by timestamp asc, id asc').fetchall()
+
+            if password is None:
+                return self.execute('select media.* from albums join media_in_albums on media_in_albums.album_id=albums.id join media on media.id=media_in_albums.media_id where albums.id=? and albums.password is null', (album_id,)).fetchall()
+            else:
+                return self.execute('select media.* from albums join media_in_albums on media_in_albums.album_id=albums.id join media on media.id=media_in_albums.media_id where albums.id=? and albums.password=sha2(?,256)', (album_id, password)).fetchall()
+
+    def query_media_page(self, after=None, limit=None, columns=None):
+        """
+        @after: (timestamp, id) of the last row of the previous page, or None
+                for the first page
+        @limit: number of rows per page (default: config.MEDIA_PAGE_SIZE)
+        @columns: media columns to return (default: all); timestamp and id
+                  are always included
+
+        Returns one page of media in the order of query_media(), i.e. by
+        timestamp (undated media first) and then by id. Pages are addressed
+        by the last row of the previous page rather than by offset, so every
+        page costs a single index range scan, however deep into the library
+        it is.
+        """
+
+        if limit is None:
+            limit = config.MEDIA_PAGE_SIZE
+
+        if columns is None:
+            columns = media_columns
+        for column in columns:
+            if column not in media_columns:
+                raise ValueError(f'column={column} is not a media column.')
+        columns = ['id', 'timestamp'] + [column for column in columns if column not in ('id', 'timestamp')]
+
+        if after is None:
+            condition, params = '', ()
+        elif after[0] is None:
+            # undated media come first, ordered by id:
+            condition, params = 'where (timestamp is null and id>?) or timestamp is not null', (after[1],)
+        else:
+            condition, params = 'where timestamp>? or (timestamp=? and id>?)', (after[0], after[0], after[1])
+
+        with self.connection():
+            return self.execute(f'select {",".join(columns)} from media {condition} order by timestamp asc, id asc limit ?', params + (limit,)).fetchall()
+
+    def iter_media(self, limit=None, columns=None):
+        """
+        Generator over the pages of query_media_page(), from the first to the
+        last. Each page is a separate query, so the shared cursor is free in
+        between pages.
+        """
+
+        after = None
+        while True:
+            page = self.query_media_page(after=after, limit=limit, columns=columns)
+            if len(page) == 0:
+                return
+            yield page
+            after = (page[-1]['timestamp'], page[-1]['id'])
+
+    def set_album_password(self, album_id, password):
+        with self.connection():
+            self.execute('update albums set password=sha2(?,256) where id=?', (password, album_id))
+
+    def unset_album_password(self, album_id):
+        with self.connection():
+            self.execute('update albums set password=NULL where id=?', (album_id,))
+
+    def validate_album_password(self, album_id=None, password=None):
+        with self.connection():
+            return len(self.execute('select id from albums where id=? and password=sha2(?,256)', (album_id, password)).fetchall()) > 0
+
+    def delete_album(self, album_id):
+        with self.transaction():
+            self.execute('delete from albums_in_collections where album_id=?', (album_id,))
+            self.execute('delete from media_in_albums where album_id=?', (album_id,))
+            self.execute('delete from albums where id=?', (album_id,))
+
+    def query_albums(self, collection_id=None):
+        """
+        @collection_id: collection to list (default: all albums)
+
+        Returns the id, name and lock state of the albums, in the order of
+        their names.
+        """
+
+        with self.connection():
+            if collection_id is None:
+                return self.execute('select id,name,password is not null as locked from albums order by name asc').fetchall()
+            else:
+                return self.execute('select albums.id,albums.name,albums.password is not null as locked from albums_in_collections join albums on albums.id=albums_in_collections.album_id where albums_in_collections.collection_id=? order by albums.name asc', (collection_id,)).fetchall()
+
+    def query_collections(self):
+        with self.connection():
+            return self.execute('select id,name from collections order by name asc').fetchall()
+
+class DiskCache:
+    """
+    Size-bounded cache of the files under @root.
+
+    Files are evicted in least-recently-used order, based on their access
+    time, whenever the cache grows over its byte budget. The access time is
+    set explicitly on every hit, so the order survives restarts and noatime
+    mounts. Subclasses decide what the files are and how they are named.
+    """
+
+    def __init__(self, root, budget):
+        self.root = root
+        self.budget = budget
+        self.lock = threading.RLock()
+
+        # {path: [atime, size]}, populated on first use by scan():
+        self.entries = None
+        self.size = 0
+
+    def scan(self):
+        with self.lock:
+            self.entries = {}
+            self.size = 0
+            stack = [self.root]
+            while stack:
+                directory = stack.pop()
+                try:
+                    with os.scandir(directory) as entries:
+                        for entry in entries:
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                            elif entry.is_file():
+                                stat = entry.stat()
+                                self.entries[entry.path] = [stat.st_atime_ns, stat.st_size]
+                                self.size += stat.st_size
+                except OSError as e:
+                    logging.warning(f'cannot read directory {directory}: {e}')
+
+    def touch(self, path):
+        now = time.time_ns()
+        try:
+            os.utime(path, ns=(now, os.stat(path).st_mtime_ns))
+        except OSError:
+            return
+
+        with self.lock:
+            if self.entries is not None and path in self.entries:
+                self.entries[path][0] = now
+
+    def add(self, path):
+        with self.lock:
+            if self.entries is None:
+                self.scan()
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return
+
+            if path in self.entries:
+                self.size -= self.entries[path][1]
+            self.entries[path] = [stat.st_atime_ns, stat.st_size]
+            self.size += stat.st_size
+
+            if self.size > self.budget:
+                self.evict()
+
+    def discard(self, path):
+        with self.lock:
+            try:
+                os.remove(path)
+            except OSError:
+                return
+
+            if self.entries is not None and path in self.entries:
+                self.size -= self.entries.pop(path)[1]
+
+    def evict(self):
+        """
+        Removes the least recently used files until the cache is 10% under
+        its budget, so that eviction does not run on every addition.
+        """
+
+        with self.lock:
+            target = 0.9*self.budget
+            for path in sorted(self.entries, key=lambda path: self.entries[path][0]):
+                if self.size <= target:
+                    break
+                self.discard(path)
+
+class PreviewCache(DiskCache):
+    """
+    Size-bounded cache of the previews in config.THUMBNAIL_DIR, keyed by
+    the content hash of the media. Evicted or missing previews are
+    regenerated from the original media the next time they are requested.
+    """
+
+    def __init__(self, root=None, budget=None):
+        super().__init__(root=config.THUMBNAIL_DIR if root is None else root, budget=config.THUMBNAIL_CACHE_SIZE if budget is None else budget)
+
+    def register(self, keys):
+        """
+        Adds all existing preview levels of @keys, generated elsewhere (for
+        example by the import workers), to the cache.
+        """
+
+        for key in keys:
+            for size in config.PREVIEW_SIZES:
+                if os.path.exists(preview_path(key, size)):
+                    self.add(preview_path(key, size))
+
+    def get(self, key, size, filename, mimetype):
+        """
+        @key: content hash of the media (media.thumbnail)
+        @size: preview level
+        @filename: original media file
+        @mimetype: mimetype of @filename
+
+        Returns the path to the @size preview of @key, regenerating it from
+        @filename if it is not in the cache.
+        """
+
+        path = preview_path(key, size)
+        if os.path.exists(path):
+            self.touch(path)
+            return path
+
+        logging.info(f'regenerating the {size} preview of {filename}.')
+        try:
+            regenerate_preview(key, size, filename, mimetype)
+        except Exception as e:
+            logging.warning(f'failed to regenerate the preview of {filename}: {e}')
+            return path
+
+        self.add(path)
+        return path
+
+    def select(self, key, filename, width, height):
+        """
+        Same as select_preview(), but counts as an access to the selected
+        preview.
+        """
+
+        path = select_preview(key, filename, width, height)
+        if path != filename:
+            self.touch(path)
+        return path
+
+    def remove(self, key):
+        """
+        Removes all preview levels of @key.
+        """
+
+        for size in config.PREVIEW_SIZES:
+            self.discard(preview_path(key, size))
+
+    def collect_garbage(self, keys):
+        """
+        @keys: set of content hashes that are still in use
+
+        Removes all previews whose key is not in @keys. Returns the number of
+        removed files.
+        """
+
+        with self.lock:
+            if self.entries is None:
+                self.scan()
+
+            orphans = [path for path in self.entries if os.path.basename(path).split('.')[0].split('-')[0] not in keys]
+            for path in orphans:
+                self.discard(path)
+
+        logging.info(f'removed {len(orphans)} orphaned previews.')
+        return len(orphans)
+
+class RenditionCache(DiskCache):
+    """
+    Size-bounded cache of the cast renditions in config.RENDITION_DIR,
+    keyed by media id and cast profile. Renditions are evicted in the same
+    least-recently-used order as previews, and one that is older than its
+    original is stale and ignored, so edited media are rendered again.
+    """
+
+    def __init__(self, root=None, budget=None):
+        super().__init__(root=config.RENDITION_DIR if root is None else root, budget=config.RENDITION_CACHE_SIZE if budget is None else budget)
+
+    def path(self, media_id, profile):
+        return os.path.join(self.root, f'{media_id}-{profile}.{cast_profiles[profile]["extension"]}')
+
+    def lookup(self, media_id, profile, filename):
+        """
+        Returns the path to the @profile rendition of @media_id, or None if
+        there is no rendition that is newer than the original @filename.
+        """
+
+        path = self.path(media_id, profile)
+        try:
+            if os.stat(path).st_mtime_ns < os.stat(filename).st_mtime_ns:
+                return None
+        except OSError:
+            return None
+
+        self.touch(path)
+        return path
+
+    def remove(self, media_id):
+        """
+        Removes all renditions of @media_id.
+        """
+
+        for profile in cast_profiles:
+            self.discard(self.path(media_id, profile))
+
+class VideoThumbnailer:
+    """
+    Bounded pool of ffmpeg processes that extract video thumbnails.
+
+    Each job decodes a single keyframe close to the middle of the video
+    and is killed if it does not finish within the timeout, so a broken file
+    cannot hang an import. Queued and running jobs can be cancelled, all of
+    them or only those of one import.
+    """
+
+    def __init__(self, workers=None, timeout=None):
+        self.pool = ThreadPoolExecutor(max_workers=config.VIDEO_WORKERS if workers is None else workers, thread_name_prefix='video-thumbnailer')
+        self.timeout = config.VIDEO_THUMBNAIL_TIMEOUT if timeout is None else timeout
+        self.lock = threading.Lock()
+        # {job: token} of the queued and running jobs, and the ffmpeg
+        # processes and cancellations of the running ones by token:
+        self.jobs = {}
+        self.processes = {}
+        self.cancelled = set()
+
+    def submit(self, filename, width, height, duration, key):
+        """
+        Queues a thumbnail job for @filename. The video dimensions and
+        duration are taken from the probe done on import. Returns a future
+        that resolves to @key.
+        """
+
+        token = object()
+        with self.lock:
+            job = self.pool.submit(self.run, filename, width, height, duration, key, token)
+            self.jobs[job] = token
+        job.add_done_callback(self.on_job_done)
+        return job
+
+    def on_job_done(self, job):
+        with self.lock:
+            self.cancelled.discard(self.jobs.pop(job, None))
+
+    def run(self, filename, width, height, duration, key, token):
+        path = preview_path(key, 256)
+        os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+
+        with self.lock:
+            if token in self.cancelled:
+                raise concurrent.futures.CancelledError()
+        process = video_thumbnail_stream(filename, width, height, duration, path).run_async(pipe_stdout=True, pipe_stderr=True)
+        with self.lock:
+            self.processes[token] = process
+            # cancelled while ffmpeg was starting:
+            if token in self.cancelled:
+                process.kill()
+        try:
+            wait_for_ffmpeg(process, self.timeout)
+        finally:
+            with self.lock:
+                del self.processes[token]
+
+        return key
+
+    def cancel(self, jobs=None):
+        """
+        @jobs: futures returned by submit() (default: all jobs)
+
+        Cancels the queued jobs among @jobs and kills the running ones.
+        """
+
+        # a cancelled job calls on_job_done() right away, so jobs are
+        # cancelled outside the lock; the running ones remain:
+        with self.lock:
+            jobs = [job for job in (list(self.jobs) if jobs is None else jobs) if job in self.jobs]
+        jobs = [job for job in jobs if not job.cancel()]
+
+        with self.lock:
+            for job in jobs:
+                token = self.jobs.get(job, None)
+                if token is None:
+                    continue
+                self.cancelled.add(token)
+                process = self.processes.get(token, None)
+                if process is not None:
+                    process.kill()
+
+    def shutdown(self):
+        self.cancel()
+        self.pool.shutdown(wait=True)
+
+class Transcoder:
+    """
+    Background priority queue that renders cast-compatible versions of
+    media (see cast_profiles) into a RenditionCache.
+
+    Jobs run in worker threads in priority order, lowest first: media that
+    are about to be cast go ahead of renditions prepared in the background.
+    Resubmitting a queued job with a higher priority moves it forward.
+    ffmpeg jobs are killed if they exceed the timeout, and all running jobs
+    are killed on shutdown.
+    """
+
+    cast_priority = 0
+    background_priority = 10
+
+    def __init__(self, db, cache=None, workers=None, timeout=None):
+        """
+        @db: MedievalDB instance to look the media up in
+        @cache: rendition cache (default: the one of @db)
+        @workers: number of concurrent jobs (default: config.TRANSCODE_WORKERS)
+        @timeout: seconds after which a job is abandoned (default:
+                  config.TRANSCODE_TIMEOUT)
+        """
+
+        self.db = db
+        self.cache = db.renditions if cache is None else cache
+        self.timeout = config.TRANSCODE_TIMEOUT if timeout is None else timeout
+
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        # {(media_id, profile): priority} of the queued jobs:
+        self.pending = {}
+        self.processes = set()
+        self.done = 0
+        self.failed = 0
+
+        self.threads = [threading.Thread(target=self.work, name='transcoder', daemon=True) for i in range(config.TRANSCODE_WORKERS if workers is None else workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def profile(self, entry):
+        """
+        Returns the cast profile that media @entry has to be rendered with,
+        or None if the original can be cast as it is.
+        """
+
+        metadata = None
+        if 'video' in entry['mimetype']:
+            metadata = self.db.query_media_metadata(entry['id'])
+            if metadata is None:
+                metadata = self.db.refresh_media_metadata(entry['id'])
+        return cast_profile(entry, metadata)
+
+    def rendition(self, media_id, profile):
+        """
+        Returns the path to the @profile rendition of @media_id, or None if
+        it has not been rendered (yet).
+        """
+
+        entry = self.db.query_media_by_id(media_id)
+        if entry is None or profile not in cast_profiles:
+            return None
+        return self.cache.lookup(media_id, profile, entry['filename'])
+
+    def submit(self, media_id, priority=None):
+        """
+        Queues the rendition of @media_id at @priority (default:
+        background_priority), unless it is already rendered or queued with
+        at least that priority. Returns the profile of the rendition, or
+        None if the media does not need one.
+        """
+
+        if priority is None:
+            priority = self.background_priority
+
+        entry = self.db.query_media_by_id(media_id)
+        if entry is None:
+            return None
+        profile = self.profile(entry)
+        if profile is None or self.cache.lookup(media_id, profile, entry['filename']) is not None:
+            return profile
+
+        key = (media_id, profile)
+        with self.lock:
+            if key in self.pending and self.pending[key] <= priority:
+                return profile
+            self.pending[key] = priority
+        self.queue.put((priority, next(self.counter), media_id, profile))
+        return profile
+
+    def work(self):
+        while True:
+            priority, counter, media_id, profile = self.queue.get()
+            if media_id is None:
+                return
+
+            with self.lock:
+                # skip the queue entries that a resubmission has superseded:
+                if self.pending.get((media_id, profile), None) != priority:
+                    continue
+                del self.pending[(media_id, profile)]
+
+            try:
+                self.run(media_id, profile)
+                with self.lock:
+                    self.done += 1
+            except Exception as e:
+                with self.lock:
+                    self.failed += 1
+                logging.warning(f'failed to render the {profile} rendition of media {media_id}: {e!r}')
+
+    def run(self, media_id, profile):
+        entry = self.db.query_media_by_id(media_id)
+        if entry is None or self.cache.lookup(media_id, profile, entry['filename']) is not None:
+            return
+
+        path = self.cache.path(media_id, profile)
+        partial = path + '.part'
+        os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+
+        start = time.perf_counter()
+        try:
+            if cast_profiles[profile]['mimetype'].startswith('image'):
+                image = decode_for_display(entry['filename'], cast_profiles[profile]['width'], cast_profiles[profile]['height'])
+                image.save(partial, format='JPEG', quality=90)
+            else:
+                process = cast_video_stream(entry['filename'], partial, profile).run_async(pipe_stdout=True, pipe_stderr=True)
+                with self.lock:
+                    self.processes.add(process)
+                try:
+                    wait_for_ffmpeg(process, self.timeout)
+                finally:
+                    with self.lock:
+                        self.processes.discard(process)
+
+            # renditions only appear in the cache once they are complete:
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+        self.cache.add(path)
+        logging.info(f'rendered the {profile} rendition of {entry["filename"]} in {time.perf_counter()-start:.1f}s.')
+
+    def statistics(self):
+        with self.lock:
+            return {
+                'queued': len(self.pending),
+                'running': len(self.processes),
+                'done': self.done,
+                'failed': self.failed,
+            }
+
+    def shutdown(self):
+        """
+        Drops the queued jobs, kills the running ones and stops the workers.
+        """
+
+        with self.lock:
+            self.pending.clear()
+            for process in self.processes:
+                process.kill()
+        for thread in self.threads:
+            # sorts after every job:
+            self.queue.put((math.inf, next(self.counter), None, None))
+        for thread in self.threads:
+            thread.join()
+
+def parse_timestamp(timestamp):
+    """
+    @timestamp: EXIF ('2021:07:14 18:03:22') or ISO date string, datetime,
+                or 'NULL'
+
+    Returns @timestamp as a naive datetime, or None if it is missing or
+    malformed (cameras without a clock write '0000:00:00 00:00:00').
+    """
+
+    if timestamp is None or timestamp == 'NULL':
+        return None
+    if isinstance(timestamp, datetime.datetime):
+        return timestamp
+
+    try:
+        return datetime.datetime.strptime(timestamp.strip()[:19], '%Y:%m:%d %H:%M:%S')
+    except ValueError:
+        pass
+
+    try:
+        return parser.parse(timestamp).replace(tzinfo=None)
+    except (ValueError, OverflowError):
+        return None
+
+def path_prefix_pattern(path):
+    """
+    Returns a LIKE pattern that matches everything below directory @path.
+    """
+
+    prefix = os.path.abspath(path).rstrip('/') + '/'
+    return prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def scan_directory(path, known_dirs=None, errors=None):
+    """
+    @path: directory to walk
+    @known_dirs: dictionary {directory: mtime} from a previous scan
+    @errors: optional list that the directories and files that could not be
+             read are appended to; their entries are missing from the scan
+
+    Recursively walks @path with os.scandir() and yields (path, size, mtime,
+    is_dir) tuples as entries are found, with mtime in nanoseconds. The
+    mtime of a directory only changes when entries are added, removed or
+    renamed, so files in directories whose mtime matches @known_dirs are not
+    stat'ed; their size and mtime are yielded as None. This also means that
+    a file rewritten in place (for example by an EXIF editor) goes unnoticed
+    until its directory changes; pass no @known_dirs to stat everything.
+    """
+
+    if known_dirs is None:
+        known_dirs = {}
+
+    root = os.path.abspath(path)
+    stack = [(root, os.stat(root).st_mtime_ns)]
+
+    while stack:
+        directory, mtime = stack.pop()
+        yield directory, None, mtime, True
+
+        unchanged = known_dirs.get(directory, None) == mtime
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((entry.path, entry.stat(follow_symlinks=False).st_mtime_ns))
+                        elif entry.is_file():
+                            if unchanged:
+                                yield entry.path, None, None, False
+                            else:
+                                stat = entry.stat()
+                                yield entry.path, stat.st_size, stat.st_mtime_ns, False
+                    except OSError as e:
+                        logging.warning(f'cannot access {entry.path}: {e}')
+                        if errors is not None:
+                            errors.append(entry.path)
+        except OSError as e:
+            logging.warning(f'cannot read directory {directory}: {e}')
+            if errors is not None:
+                errors.append(directory)
+
+# PIL transpose operations that undo each EXIF orientation:
+orientation_transposes = {
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90,
+}
+
+def extract_exif_thumbnail(image):
+    """
+    Returns the JPEG thumbnail embedded in the EXIF block (IFD1) of @image,
+    or None if there isn't one. Only the EXIF bytes are parsed, the image
+    itself is not decoded.
+    """
+
+    data = image.info.get('exif', None)
+    if not data:
+        return None
+    if data.startswith(b'Exif\x00\x00'):
+        data = data[6:]
+
+    endian = '<' if data[:2] == b'II' else '>'
+    try:
+        ifd0 = struct.unpack(endian+'I', data[4:8])[0]
+        count = struct.unpack(endian+'H', data[ifd0:ifd0+2])[0]
+        ifd1 = struct.unpack(endian+'I', data[ifd0+2+12*count:ifd0+6+12*count])[0]
+        if ifd1 == 0:
+            return None
+
+        offset, length = None, None
+        count = struct.unpack(endian+'H', data[ifd1:ifd1+2])[0]
+        for i in range(count):
+            entry = data[ifd1+2+12*i:ifd1+14+12*i]
+            tag, kind = struct.unpack(endian+'HH', entry[:4])
+            value = struct.unpack(endian+'H', entry[8:10])[0] if kind == 3 else struct.unpack(endian+'I', entry[8:12])[0]
+            if tag == 0x0201:  # JPEGInterchangeFormat
+                offset = value
+            elif tag == 0x0202:  # JPEGInterchangeFormatLength
+                length = value
+
+        if offset is None or length is None:
+            return None
+
+        thumbnail = Image.open(io.BytesIO(data[offset:offset+length]))
+        thumbnail.load()
+        return thumbnail
+    except (struct.error, OSError, ValueError):
+        return None
+
+def hash_file(filename):
+    """
+    Returns the content hash of @filename. The hash is 32 characters long
+    and names the previews of the media (see preview_path()). It covers the
+    size of the file and the blocks of hash_ranges(), so hashing a
+    multi-gigabyte video reads half a megabyte rather than all of it.
+    """
+
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        content = ContentHash(size)
+        for offset, length in content.ranges:
+            f.seek(offset)
+            content.update(f.read(length), offset)
+    return content.hexdigest()
+
+def hash_ranges(size, block_size=1 << 16, samples=8):
+    """
+    Returns the (offset, length) ranges of a file of @size bytes that its
+    content hash covers: the whole file if it is small, otherwise @samples
+    blocks spread evenly from its head to its tail. Media that differ
+    anywhere nearly always differ in size or in the head, where the
+    metadata lives, so the samples are enough to tell them apart.
+    """
+
+    if size <= samples*block_size:
+        return [(0, size)]
+
+    step = (size - block_size)/(samples - 1)
+    return [(round(i*step), block_size) for i in range(samples)]
+
+class ContentHash:
+    """
+    Computes the content hash of hash_file() from the bytes of a file of
+    @size bytes as they stream by, for example during a copy.
+    """
+
+    def __init__(self, size):
+        self.digest = hashlib.blake2b(digest_size=16)
+        self.digest.update(size.to_bytes(8, 'little'))
+        self.ranges = hash_ranges(size)
+
+    def update(self, data, position):
+        """
+        Hashes the parts of @data, read at @position in the file, that
+        belong to the hash. The file has to be fed in order.
+        """
+
+        end = position + len(data)
+        for offset, length in self.ranges:
+            start, stop = max(offset, position), min(offset+length, end)
+            if start < stop:
+                self.digest.update(data[start-position:stop-position])
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+# ioctl that clones the extents of one file into another (linux/fs.h):
+FICLONE = 0x40049409
+
+def copy_file(source, destination, chunk_size=None):
+    """
+    @source: path of the file to copy
+    @destination: path of the copy; an existing file is overwritten
+    @chunk_size: buffer size of the streaming copy (default:
+                 config.IMPORT_COPY_BUFFER)
+
+    Copies @source to @destination the cheapest way the filesystems allow:
+    a reflink, which shares the data blocks on copy-on-write filesystems
+    (btrfs, XFS); an in-kernel os.copy_file_range(); or a streaming copy
+    through a large buffer. The streaming copy computes the content hash
+    (see hash_file()) of the bytes it reads from @source in the same pass.
+    The other two hash both files, whose sampled blocks are shared or
+    still in the page cache, and a mismatch raises OSError; so does a copy
+    whose size does not match @source. The hash samples the file, so this
+    is a sanity check rather than a full comparison. Like shutil.copy2(),
+    the copy keeps the permissions and timestamps of @source. Returns the
+    hash of @source and the copy method.
+    """
+
+    if chunk_size is None:
+        chunk_size = config.IMPORT_COPY_BUFFER
+
+    with open(source, 'rb', buffering=0) as src, open(destination, 'wb', buffering=0) as dst:
+        size = os.fstat(src.fileno()).st_size
+        key = None
+
+        method = 'reflink'
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except (AttributeError, OSError):
+            method = 'copy_file_range'
+
+        if method == 'copy_file_range':
+            try:
+                copied = 0
+                while copied < size:
+                    count = os.copy_file_range(src.fileno(), dst.fileno(), min(size-copied, 1 << 30))
+                    if count == 0:
+                        break
+                    copied += count
+            except (AttributeError, OSError):
+                # not supported by the kernel or across these filesystems;
+                # start over:
+                method = 'stream'
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+
+        if method == 'stream':
+            content = ContentHash(size)
+            buffer = memoryview(bytearray(chunk_size))
+            position = 0
+            while True:
+                count = src.readinto(buffer)
+                if not count:
+                    break
+                content.update(buffer[:count], position)
+                position += count
+                written = 0
+                while written < count:
+                    written += dst.write(buffer[written:count])
+            key = content.hexdigest()
+
+        if os.fstat(dst.fileno()).st_size != size:
+            raise OSError(f'copy of {source} to {destination} is incomplete.')
+
+    if key is None:
+        key = hash_file(source)
+        if hash_file(destination) != key:
+            raise OSError(f'copy of {source} to {destination} does not match the original.')
+
+    shutil.copystat(source, destination)
+    return key, method
+
+def preview_path(key, size=256):
+    """
+    @key: content hash of the media (media.thumbnail)
+    @size: preview level (one of config.PREVIEW_SIZES)
+
+    Returns the path of a preview. Previews are spread over two levels of
+    subdirectories named after the hash so that no directory grows too
+    large. Thumbnails imported before the previews were content-addressed
+    have a random 16-character name and live directly in THUMBNAIL_DIR.
+    """
+
+    if len(key) == 16:
+        return config.THUMBNAIL_DIR + f'/{key}.jpg'
+    return config.THUMBNAIL_DIR + f'/{key[:2]}/{key[2:4]}/{key}-{size}.jpg'
+
+def select_preview(key, filename, width, height):
+    """
+    Returns the smallest preview of @key that covers a @width x @height
+    area, or the original @filename if no preview is large enough.
+    """
+
+    target = max(width, height)
+    if target <= 0:
+        target = max(config.PREVIEW_SIZES)
+
+    if len(key) == 16:
+        return filename
+
+    for size in sorted(config.PREVIEW_SIZES):
+        if size >= target:
+            # levels larger than the image itself are not generated:
+            path = preview_path(key, size)
+            return path if os.path.exists(path) else filename
+
+    return filename
+
+def save_preview(image, path):
+    os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image.save(path, quality=90)
+
+def decode_preview(image, size):
+    """
+    @image: PIL image, not yet loaded
+    @size: size of the longer side of the preview
+
+    Decodes @image for a preview of @size, using the cheapest decode that
+    still covers it:
+
+    * 'exif': the thumbnail embedded in EXIF, if it is large enough and has
+      the aspect ratio of the image;
+    * 'draft': a JPEG decoded at a reduced (DCT-scaled) resolution;
+    * 'full': a full decode, for everything else.
+
+    Returns the oriented preview and the method that was used.
+    """
+
+    thumbnail = extract_exif_thumbnail(image)
+    if thumbnail is not None and max(thumbnail.size) >= size and abs(thumbnail.width/thumbnail.height - image.width/image.height) < 0.01:
+        method = 'exif'
+        thumbnail.thumbnail((size, size), Image.LANCZOS)
+        transpose = orientation_transposes.get(image.getexif().get(exif_ids['Orientation'], 1), None)
+        oriented_image = thumbnail.transpose(transpose) if transpose is not None else thumbnail
+    else:
+        original_size = image.size
+        if image.format == 'JPEG':
+            # draft() picks the smallest DCT scale that covers the requested
+            # size on both sides, so it is asked for the size of the preview
+            # itself, not for a square that the short side never reaches:
+            scale = size/max(image.size)
+            image.draft(image.mode, (max(1, round(image.width*scale)), max(1, round(image.height*scale))))
+        method = 'draft' if image.size != original_size else 'full'
+        image.thumbnail((size, size), Image.LANCZOS)
+        oriented_image = ImageOps.exif_transpose(image)
+
+    return oriented_image, method
+
+def decode_for_display(path, width, height):
+    """
+    @path: image file (an original or a preview)
+    @width: width of the display area, in pixels
+    @height: height of the display area, in pixels
+
+    Decodes @path for a @width x @height display area. JPEGs are decoded
+    at a reduced (DCT-scaled) resolution, anything larger than the area is
+    downscaled to fit before it is oriented, and the pixels are converted
+    by convert_for_display(), so the result is never larger than what is
+    shown. Returns the RGB or RGBA image.
+    """
+
+    if width <= 0 or height <= 0:
+        width = height = max(config.PREVIEW_SIZES)
+
+    with Image.open(path) as image:
+        orientation = image.getexif().get(exif_ids['Orientation'], 1)
+        if orientation in (5, 6, 7, 8):
+            # the image is rotated by 90 degrees when displayed:
+            width, height = height, width
+
+        if image.format == 'JPEG':
+            image.draft(image.mode, (width, height))
+        # after a draft decode, the remaining downscale is less than 2x, where
+        # the short Hamming filter looks as good as Lanczos at a third of
+        # the cost:
+        image.thumbnail((width, height), Image.HAMMING)
+        # thumbnail() does not load images that already fit:
+        image.load()
+        image = convert_for_display(image)
+
+    transpose = orientation_transposes.get(orientation, None)
+    return image.transpose(transpose) if transpose is not None else image
+
+def convert_for_display(image):
+    """
+    @image: PIL image in any mode
+
+    Returns @image as RGBA if it has transparency and as RGB otherwise.
+    High bit-depth grayscale and floating-point images are stretched to
+    their own range, and modes that PIL cannot convert to RGB (such as LAB)
+    are shown by their first band.
+    """
+
+    if image.mode in ('RGB', 'RGBA'):
+        return image
+
+    alpha = image.mode in ('LA', 'PA', 'RGBa', 'La') or 'transparency' in image.info
+
+    if image.mode.startswith('I') or image.mode == 'F':
+        if image.mode.startswith('I;16'):
+            image = image.convert('I')
+        low, high = image.getextrema()
+        if high <= low:
+            low, high = 0, 255
+        scale = 255/(high-low)
+        image = image.point(lambda value: (value-low)*scale).convert('L')
+
+    try:
+        return image.convert('RGBA' if alpha else 'RGB')
+    except ValueError:
+        return image.getchannel(0).convert('RGB')
+
+def generate_thumbnail(filename, image, size=256, key=None):
+    """
+    @filename: path to the image
+    @image: PIL image opened from @filename, not yet loaded
+    @size: size of the longer thumbnail side
+    @key: content hash of @filename (computed if not given)
+
+    Generates a single preview level of @image. Returns the key and the
+    decode method (see decode_preview()).
+    """
+
+    if key is None:
+        key = hash_file(filename)
+
+    thumbnail, method = decode_preview(image, size)
+    save_preview(thumbnail, preview_path(key, size))
+
+    logging.debug(f'thumbnail for {filename} generated with the {method} method.')
+    return key, method
+
+def generate_previews(filename, image, key, sizes=None):
+    """
+    @filename: path to the image
+    @image: PIL image opened from @filename, not yet loaded
+    @key: content hash of @filename
+    @sizes: preview levels (default: config.PREVIEW_SIZES)
+
+    Generates the preview pyramid of @image: the grid thumbnail plus every
+    larger level that is still smaller than the image itself. The image is
+    decoded once for the largest level and then downscaled level by level;
+    EXIF thumbnails are too small for that level, so they only serve
+    single-level previews (generate_thumbnail()). Returns the decode method
+    (see decode_preview()), or 'cached' if all levels of this content
+    already exist.
+    """
+
+    if sizes is None:
+        sizes = config.PREVIEW_SIZES
+    sizes = sorted(sizes)
+
+    levels = sizes[:1] + [size for size in sizes[1:] if size < max(image.size)]
+    paths = {size: preview_path(key, size) for size in levels}
+    if all(os.path.exists(path) for path in paths.values()):
+        return 'cached'
+
+    preview, method = decode_preview(image, levels[-1])
+    for size in reversed(levels):
+        preview.thumbnail((size, size), Image.LANCZOS)
+        save_preview(preview, paths[size])
+
+    logging.debug(f'previews for {filename} generated with the {method} method.')
+    return method
+
+def video_thumbnail_stream(filename, width, height, duration, path):
+    """
+    Returns the ffmpeg stream that writes a thumbnail of @filename to @path.
+    The input is seeked to the keyframe nearest to the middle of the video
+    and only keyframes are decoded, so no frames are decoded just to reach
+    the seek point.
+    """
+
+    xsize = 256 if width >= height else -1
+    ysize = -1 if width >= height else 256
+
+    return ffmpeg.input(filename, ss=duration // 2, noaccurate_seek=None, skip_frame='nokey').filter('scale', xsize, ysize).output(path, vframes=1).overwrite_output()
+
+def wait_for_ffmpeg(process, timeout):
+    try:
+        out, err = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise
+
+    if process.returncode != 0:
+        raise ffmpeg.Error('ffmpeg', out, err)
+
+def generate_video_thumbnail(filename, width, height, duration, key=None):
+    if key is None:
+        key = hash_file(filename)
+
+    path = preview_path(key, 256)
+    os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+
+    process = video_thumbnail_stream(filename, width, height, duration, path).run_async(pipe_stdout=True, pipe_stderr=True)
+    wait_for_ffmpeg(process, config.VIDEO_THUMBNAIL_TIMEOUT)
+    return key
+
+def regenerate_preview(key, size, filename, mimetype):
+    """
+    Regenerates a single preview level of @filename that has been evicted
+    from (or never made it into) the preview cache.
+    """
+
+    if 'image' in mimetype:
+        with Image.open(filename) as im:
+            generate_thumbnail(filename, im, size=size, key=key)
+    elif 'video' in mimetype:
+        meta = ffmpeg.probe(filename)
+        stream = [stream for stream in meta['streams'] if stream['codec_type'] == 'video'][0]
+        generate_video_thumbnail(filename, int(stream['width']), int(stream['height']), float(meta['format']['duration']), key=key)
+    else:
+        raise ValueError(f'mimetype {mimetype} not recognized.')
+
+def get_video_timestamp(metadata):
+    """
+    Alas, there seems to be no clear standard for including timestamps in
+    the videos. Here we try several common options in the hope that
+    something will work.
+    """
+
+    # regex rules:
+    regex_rules = [r'\d{8}.\d{6}', r'\d{8}']
+
+    # try creation time:
+    tags = metadata['format'].get('tags', None)
+    if tags:
+        ct = metadata['format']['tags'].get('creation_time', None)
+        if ct:
+            iso = parser.parse(ct)
+            return f'{iso.date()} {iso.time()}'
+
+    # try the filename:
+    filename = metadata['format'].get('filename', None)
+    if filename:
+        for rule in regex_rules:
+            match = re.search(rule, filename)
+            if match is None:
+                continue
+            iso = parser.parse(filename[match.start():match.end()].replace('_', '-'))
+            return f'{iso.date()} {iso.time()}'
+
+    return 'NULL'
+
+def move_to_album(path, filename, timestamp, key):
+    """
+    @path: copy of @filename to move into the album
+    @filename: original path of the media file
+    @timestamp: date the media was taken
+    @key: content hash of @path
+
+    Moves @path into the album directory of the day the media was taken,
+    under the name of @filename. Files from different cameras often share
+    names, so an existing file is never replaced: if it has the same
+    content (same hash, then byte for byte), the copy is dropped and the
+    existing file is returned;
+    otherwise the copy gets a -1, -2, ... suffix. Returns the path of the
+    media in the album.
+    """
+
+    try:
+        ts = timestamp.split(' ')[0].replace(':', '-')
+    except:
+        ts = 'NULL'
+
+    directory = config.ALBUM_DIR + f'/{ts}/'
+    os.makedirs(directory, mode=0o755, exist_ok=True)
+
+    stem, ext = os.path.splitext(os.path.basename(filename))
+    for n in itertools.count():
+        destination = directory + (stem if n == 0 else f'{stem}-{n}') + ext
+        try:
+            # claims the name atomically, also against other workers:
+            os.close(os.open(destination, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+        except FileExistsError:
+            if hash_file(destination) == key and filecmp.cmp(destination, path, shallow=False):
+                os.remove(path)
+                return destination
+            continue
+
+        os.replace(path, destination)
+        return destination
+
+def copy_to_album(filename, timestamp):
+    staged, key = stage_media_file(filename)
+    return move_to_album(staged, filename, timestamp, key)
+
+def stage_media_file(filename):
+    """
+    @filename: absolute path to the media file
+
+    Copy stage of the import pipeline: copies @filename into the staging
+    directory of the album (see copy_file()), from where import_media_file()
+    decodes it and moves it in place once its date is known. It only does
+    I/O, so it runs in a pool of threads next to the decoding workers.
+    Returns the path of the staged copy and its content hash.
+    """
+
+    staging = config.ALBUM_DIR + '/.staging'
+    os.makedirs(staging, mode=0o755, exist_ok=True)
+    fd, staged = tempfile.mkstemp(suffix=os.path.splitext(filename)[1], dir=staging)
+    os.close(fd)
+
+    try:
+        key, method = copy_file(filename, staged)
+    except BaseException:
+        os.remove(staged)
+        raise
+
+    logging.debug(f'{filename} staged with the {method} method.')
+    return staged, key
+
+def import_media_file(filename, key=None, staged=None):
+    """
+    @filename: absolute path to the media file
+    @key: content hash of the file, if it is already known
+    @staged: copy of the file made by stage_media_file(); it is decoded in
+             place of @filename and moved into the album directory
+
+    Worker stage of the import pipeline. Decodes the file, reads its
+    metadata, generates the image previews and (unless config.IMPORT_IN_PLACE
+    is set) copies the file to the album directory. Video thumbnails are
+    left to VideoThumbnailer, using the dimensions and duration returned in
+    the 'video' entry. It does not touch the database, so it can run in a
+    separate process. Returns a dictionary of MedievalDB.add_media()
+    arguments, or None if the file is not a media file; raises an exception
+    if it is one but cannot be imported.
+    """
+
+    path = filename if staged is None else staged
+
+    mimetype = mimetypes.guess_type(filename)[0]
+    if mimetype is None:
+        logging.info(f'file {filename} has no identifiable mime type, skipping.')
+        return None
+
+    if 'image' in mimetype:
+        try:
+            im = Image.open(path)
+            exif = exif_metadata(im)
+        except Exception as e:
+            raise ValueError(f'cannot decode {filename}: {e}') from e
+
+        timestamp = exif.get('DateTimeOriginal', 'NULL')
+        width = exif.get('ExifImageWidth', im.size[0])
+        height = exif.get('ExifImageHeight', im.size[1])
+        orientation = exif.get('Orientation', -1)
+        make = exif.get('Make', '')
+        model = exif.get('Model', '')
+
+        thumbnail = key if key is not None else hash_file(path)
+        thumbnail_method = generate_previews(path, im, thumbnail)
+        video = None
+        metadata = exif
+
+    elif 'video' in mimetype:
+        try:
+            meta = ffmpeg.probe(path)
+            format = meta['format']
+            streams = meta['streams']
+            for stream in streams:
+                if stream['codec_type'] == 'video':
+                    break
+        except Exception as e:
+            raise ValueError(f'cannot probe {filename}: {e}') from e
+
+        width = int(stream['width'])
+        height = int(stream['height'])
+        duration = float(format['duration'])
+        timestamp = get_video_timestamp(meta)
+        orientation = -1
+        make = ''
+        model = ''
+
+        # the thumbnail itself is extracted by MedievalDB.video_thumbnailer:
+        thumbnail = key if key is not None else hash_file(path)
+        thumbnail_method = 'video'
+        video = {'width': width, 'height': height, 'duration': duration}
+        metadata = video_metadata(meta)
+
+    else:
+        logging.warning(f'mimetype={mimetype} not recognized as a media format, skipping.')
+        return None
+
+    if staged is not None:
+        filename = move_to_album(staged, filename, timestamp, thumbnail)
+    elif not config.IMPORT_IN_PLACE:
+        filename = copy_to_album(filename, timestamp)
+
+    return {
+        'filename': filename,
+        'thumbnail': thumbnail,
+        'mimetype': mimetype,
+        'timestamp': timestamp,
+        'width': width,
+        'height': height,
+        'orientation': orientation,
+        'make': make,
+        'model': model,
+        'description': None,
+        'thumbnail_method': thumbnail_method,
+        'video': video,
+        'metadata': metadata,
+    }
+
+def import_exif(image, taglist=ExifTags.TAGS):
+    tags = dict()
+    exif = image.getexif()
+    for tag_id in exif:
+        tag = taglist.get(tag_id, tag_id)
+        val = exif.get(tag_id)
+        if type(val) == str:
+            val = val.replace('\x00', '').strip()
+        tags[tag] = val
+    return tags
+
+def exif_value(value):
+    """
+    Converts an EXIF value to a JSON-safe equivalent: rationals become
+    floats (None if undefined), strings lose their NUL padding, short binary
+    values are hex-encoded and long binary blobs (such as maker notes) are
+    dropped.
+    """
+
+    if isinstance(value, str):
+        return value.replace('\x00', '').strip()
+    if isinstance(value, bytes):
+        if len(value) > 64:
+            return None
+        try:
+            return value.decode('ascii').replace('\x00', '').strip()
+        except UnicodeDecodeError:
+            return value.hex()
+    if isinstance(value, (tuple, list)):
+        return [exif_value(entry) for entry in value]
+    if isinstance(value, bool) or isinstance(value, int) or value is None:
+        return value
+    try:
+        value = float(value)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return str(value)
+    return value if math.isfinite(value) else None
+
+def exif_metadata(image):
+    """
+    Returns the complete EXIF of @image as a flat, JSON-safe dictionary:
+    the main IFD, the Exif IFD and the GPS IFD, keyed by tag name. This is
+    what gets stored in media_metadata for images.
+    """
+
+    exif = image.getexif()
+    ifds = [(exif, ExifTags.TAGS), (exif.get_ifd(0x8769), ExifTags.TAGS), (exif.get_ifd(0x8825), ExifTags.GPSTAGS)]
+
+    tags = dict()
+    for ifd, taglist in ifds:
+        for tag_id in ifd:
+            if tag_id in (0x8769, 0x8825):
+                # pointers to the sub-IFDs parsed above.
+                continue
+            value = exif_value(ifd.get(tag_id))
+            if value is not None:
+                tags[str(taglist.get(tag_id, tag_id))] = value
+    return tags
 
 def import_video_metadata(filename):
+    return video_metadata(ffmpeg.probe(filename))
+
+def video_metadata(contents):
+    """
+    @contents: ffmpeg.probe() output
+
+    Flattens the container-level probe output into a single dictionary and
+    adds a compact summary of the first video and audio streams. This is
+    what gets stored in media_metadata for videos.
+    """
+
     tags = dict()
-    contents = ffmpeg.probe(filename)
     for content in contents['format']:
         if type(contents['format'][content]) is dict:
             for tag in contents['format'][content]:
                 tags[tag] = contents['format'][content][tag]
             continue
         tags[content] = contents['format'][content]
+
+    for kind in ('video', 'audio'):
+        for stream in contents['streams']:
+            if stream.get('codec_type', None) != kind:
+                continue
+            for key in ('codec_name', 'profile', 'pix_fmt', 'width', 'height', 'r_frame_rate', 'bit_rate', 'sample_rate', 'channels'):
+                if key in stream:
+                    tags[f'{kind}_{key}'] = stream[key]
+            break
+
     return tags
 
-def init_chromecast():
-    # Get local IP:
-    if config.CASTER_IP is None:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+# Cast renditions: H.264/AAC video in MP4 at up to 1080p, which every
+# Chromecast generation plays without buffering, and JPEGs sized for a 1080p
+# screen. Media that do not fit these limits are rendered in the background.
+cast_profiles = {
+    'video-1080p': {'mimetype': 'video/mp4', 'extension': 'mp4', 'width': 1920, 'height': 1080, 'bit_rate': 10_000_000},
+    'image-1080p': {'mimetype': 'image/jpeg', 'extension': 'jpg', 'width': 1920, 'height': 1080},
+}
+
+def cast_profile(entry, metadata=None):
+    """
+    @entry: media entry
+    @metadata: stored metadata of the media (see video_metadata()); needed
+               for videos
+
+    Returns the profile of cast_profiles that the media has to be rendered
+    with before it can be cast, or None if the original can be cast as it
+    is.
+    """
+
+    def fits(width, height, limits):
+        if width is None or height is None:
+            return False
+        return max(width, height) <= limits['width'] and min(width, height) <= limits['height']
+
+    if 'image' in entry['mimetype']:
+        limits = cast_profiles['image-1080p']
+        # cast devices ignore the EXIF orientation, so only images that need
+        # no transpose pass through (import stores -1 when there is no tag):
+        if entry['mimetype'] in ('image/jpeg', 'image/png', 'image/gif', 'image/webp') and entry['orientation'] not in orientation_transposes and fits(entry['width'], entry['height'], limits):
+            return None
+        return 'image-1080p'
+
+    if 'video' in entry['mimetype']:
+        limits = cast_profiles['video-1080p']
+        metadata = {} if metadata is None else metadata
+        if entry['mimetype'] in ('video/mp4', 'video/webm') \
+                and metadata.get('video_codec_name', None) == 'h264' \
+                and metadata.get('video_pix_fmt', None) in ('yuv420p', 'yuvj420p') \
+                and fits(metadata.get('video_width', None), metadata.get('video_height', None), limits) \
+                and int(metadata.get('video_bit_rate', 0) or 0) <= limits['bit_rate'] \
+                and metadata.get('audio_codec_name', None) in (None, 'aac', 'mp3', 'opus', 'vorbis'):
+            return None
+        return 'video-1080p'
+
+    return None
+
+def cast_video_stream(filename, path, profile='video-1080p'):
+    """
+    Returns the ffmpeg stream that renders @filename into an MP4 at @path
+    for the cast @profile: 8-bit H.264 (high profile, level 4.1) within the
+    profile's size, in either orientation and never upscaled, with stereo
+    AAC audio and the index at the front of the file so that playback can
+    start before the download completes.
+    """
+
+    limits = cast_profiles[profile]
+    long, short = limits['width'], limits['height']
+    # the scale filter is passed as a plain option, so that its quoted
+    # expressions need no filtergraph escaping:
+    scale = f"scale=w='min(iw,if(gte(iw,ih),{long},{short}))':h='min(ih,if(gte(iw,ih),{short},{long}))':force_original_aspect_ratio=decrease:force_divisible_by=2"
+
+    return ffmpeg.input(filename).output(path, format='mp4', vf=scale, vcodec='libx264', preset='veryfast', crf=21, pix_fmt='yuv420p', maxrate=limits['bit_rate'], bufsize=2*limits['bit_rate'], acodec='aac', ac=2, movflags='+faststart', **{'profile:v': 'high', 'level:v': '4.1', 'b:a': '192k'}).overwrite_output()
+
+def local_ip():
+    """
+    Returns the address of the interface that routes to the internet. No
+    packets are sent: connecting a UDP socket only selects the route.
+    """
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
         s.connect(('8.8.8.8', 1))
-        ip = s.getsockname()[0]
-    else:
-        ip = config.CASTER_IP
+        return s.getsockname()[0]
+
+def parse_byte_range(header, size):
+    """
+    @header: value of the Range header
+    @size: size of the file, in bytes
+
+    Parses a single byte range ('bytes=0-499', 'bytes=500-', 'bytes=-500')
+    into a (start, stop) pair, with @stop exclusive and clamped to @size.
+    Returns None if the header is malformed or asks for several ranges, in
+    which case it should be ignored, and a pair with start >= stop if the
+    range cannot be satisfied.
+    """
+
+    match = re.fullmatch(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*', header)
+    if match is None or match[1] == match[2] == '':
+        return None
+
+    if match[1] == '':
+        # suffix range, the last bytes of the file:
+        length = int(match[2])
+        return (max(size-length, 0) if length > 0 else size), size
+
+    start = int(match[1])
+    if match[2] == '':
+        return start, size
+    if int(match[2]) < start:
+        return None
+    return start, min(int(match[2])+1, size)
+
+class MediaRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the media that the server has handed out for casting (see
+    MediaServer.cast_source()) at /media/<token>, and their cast
+    renditions, once rendered, at /media/<token>/<profile>. Media ids are
+    sequential, so media are only served under a random token: other
+    devices on the network cannot enumerate the library, nor reach the
+    media of locked albums that were never cast.
+
+    Responses carry an ETag and a Last-Modified date, conditional requests
+    (If-None-Match, If-Modified-Since) are answered with 304 and single
+    byte ranges with 206, honouring If-Range, so that players can seek
+    without downloading the file from the start. Connections are kept
+    alive, and file contents are sent with socket.sendfile(), which hands
+    them to os.sendfile() and so never copies them through Python.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    server_version = f'medieval/{__version__}'
+
+    def do_GET(self):
+        self.serve(body=True)
+
+    def do_HEAD(self):
+        self.serve(body=False)
+
+    def serve(self, body):
+        match = re.fullmatch(r'/media/([\w-]+)(?:/([\w-]+))?', self.path.split('?')[0])
+        media_id = None if match is None else self.server.media_id(match[1])
+        if media_id is None:
+            self.send_error(404)
+            return
+
+        profile = match[2]
+        if profile is None:
+            entry = self.server.db.query_media_by_id(media_id)
+            path, mimetype = (None, None) if entry is None else (entry['filename'], entry['mimetype'])
+        elif self.server.transcoder is not None and profile in cast_profiles:
+            path, mimetype = self.server.transcoder.rendition(media_id, profile), cast_profiles[profile]['mimetype']
+        else:
+            path, mimetype = None, None
+
+        if path is None:
+            self.send_error(404)
+            return
+
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(404, 'media file not found')
+            return
+
+        with f:
+            stat = os.fstat(f.fileno())
+            etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+            last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+
+            if self.not_modified(etag, stat.st_mtime):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                self.end_headers()
+                return
+
+            start, stop = 0, stat.st_size
+            byte_range = self.headers.get('Range', None)
+            if byte_range is not None and self.range_applies(etag, last_modified):
+                byte_range = parse_byte_range(byte_range, stat.st_size)
+            else:
+                byte_range = None
+
+            if byte_range is not None and byte_range[0] >= byte_range[1]:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{stat.st_size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            if byte_range is not None:
+                start, stop = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{stop-1}/{stat.st_size}')
+            else:
+                self.send_response(200)
+
+            self.send_header('Content-Type', mimetype or 'application/octet-stream')
+            self.send_header('Content-Length', str(stop-start))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.end_headers()
+
+            if not body or stop == start:
+                return
+
+            try:
+                self.connection.sendfile(f, start, stop-start)
+            except (BrokenPipeError, ConnectionResetError):
+                # players routinely drop a response to seek elsewhere:
+                logging.debug(f'client {self.client_address[0]} closed the connection during {self.path}.')
+                self.close_connection = True
 
-    # Initialize local server:
-    server = HTTPServer((ip, config.CASTER_PORT), SimpleHTTPRequestHandler)
-    thread = threading.Thread(target=server.serve_forever)
-    thread.daemon = True
+    def not_modified(self, etag, mtime):
+        if_none_match = self.headers.get('If-None-Match', None)
+        if if_none_match is not None:
+            # weak comparison, as required for If-None-Match:
+            tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags
+
+        if_modified_since = self.headers.get('If-Modified-Since', None)
+        if if_modified_since is not None:
+            try:
+                return int(mtime) <= email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+
+        return False
+
+    def range_applies(self, etag, last_modified):
+        # a range is only served if the file is still the one the client has:
+        if_range = self.headers.get('If-Range', None)
+        return if_range is None or if_range.strip() in (etag, last_modified)
+
+    def log_message(self, format, *args):
+        logging.debug(f'media server: {self.address_string()} {format % args}')
+
+class MediaServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server that serves media to cast devices; see
+    MediaRequestHandler. Every request is handled in its own thread, so a
+    device can fetch several ranges of a video at once while others are
+    being served.
+    """
+
+    def __init__(self, db, host=None, port=None, transcoder=None):
+        """
+        @db: MedievalDB instance to look the media up in
+        @host: address to listen on (default: config.CASTER_IP, or the
+               address of the default route if that is None)
+        @port: port to listen on (default: config.CASTER_PORT; 0 picks a
+               free one)
+        @transcoder: Transcoder whose renditions are served (default: none)
+        """
+
+        self.db = db
+        self.transcoder = transcoder
+        self.lock = threading.Lock()
+        # {token: media_id} and {media_id: token} of the media handed out:
+        self.tokens = {}
+        self.media_tokens = {}
+        if host is None:
+            host = local_ip() if config.CASTER_IP is None else config.CASTER_IP
+        super().__init__((host, config.CASTER_PORT if port is None else port), MediaRequestHandler)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='media-server', daemon=True)
+        self.thread.start()
+        logging.info(f'media server listening on {self.server_address[0]}:{self.server_address[1]}.')
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.transcoder is not None:
+            self.transcoder.shutdown()
+
+    def token(self, media_id):
+        """
+        Returns the token that @media_id is served under, drawing one the
+        first time it is handed out.
+        """
+
+        with self.lock:
+            token = self.media_tokens.get(media_id, None)
+            if token is None:
+                token = secrets.token_urlsafe(16)
+                self.tokens[token] = media_id
+                self.media_tokens[media_id] = token
+            return token
+
+    def media_id(self, token):
+        with self.lock:
+            return self.tokens.get(token, None)
+
+    def url(self, media_id, profile=None):
+        """
+        Returns the URL of @media_id (or of its @profile rendition), which
+        is served from then on.
+        """
+
+        token = self.token(media_id)
+        path = f'/media/{token}' if profile is None else f'/media/{token}/{profile}'
+        return f'http://{self.server_address[0]}:{self.server_address[1]}{path}'
+
+    def cast_source(self, media_id):
+        """
+        Returns the URL and mimetype to cast @media_id with: its rendition if
+        it needs one and it is ready, and the original otherwise. A missing
+        rendition is queued ahead of the background jobs, so it is ready
+        the next time the media is cast.
+        """
+
+        entry = self.db.query_media_by_id(media_id)
+        if entry is None:
+            raise ValueError(f'media_id={media_id} not found.')
+
+        if self.transcoder is not None:
+            profile = self.transcoder.submit(media_id, priority=Transcoder.cast_priority)
+            if profile is not None:
+                if self.transcoder.rendition(media_id, profile) is not None:
+                    return self.url(media_id, profile), cast_profiles[profile]['mimetype']
+                logging.info(f'the {profile} rendition of {entry["filename"]} is not ready, casting the original.')
+
+        return self.url(media_id), entry['mimetype']
+
+def init_chromecast(db):
+    """
+    @db: MedievalDB instance whose media are cast
+
+    Starts the media server, with a transcoder for the media that cannot be
+    cast as they are, and connects to the living room Chromecast. Returns
+    the media server and the Chromecast media controller.
+    """
 
     try:
-        thread.start()
-        logging.info('built-in casting server started.')
-    except:
-        server.shutdown()
-        raise ValueError('could not start the built-in server')
+        server = MediaServer(db, transcoder=Transcoder(db))
+        server.start()
+    except OSError as e:
+        raise ValueError(f'could not start the built-in server: {e}')
 
     # Initialize living room chromecast:
     services, browser = cc.discover_chromecasts()
@@ -369,4 +3220,4 @@ def init_chromecast():
     cast = chromecasts[0]
     cast.wait()
 
-    return cast.media_controller
+    return server, cast.media_controller
@@ -1,14 +1,20 @@
 import os
 import logging
+import collections
+import functools
+import bisect
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import config
 import engine
 
 import gi
 gi.require_version('Gtk', '4.0')
-from gi.repository import Gtk as gtk, Gdk as gdk, Gio as gio, GObject as gobject, GLib as glib, GdkPixbuf
+from gi.repository import Gtk as gtk, Gdk as gdk, Gio as gio, GObject as gobject, GLib as glib
 
-from PIL import Image, ImageFilter, ImageOps
+from PIL import Image, ImageFilter
 
 
 
@@ -183,45 +189,18 @@ class Album(gtk.Box):
                     PasswordPrompt(mode='unlock', album=self)
                     return
                 else:
-                    # remove old media:
-                    medieval.main_window.display.gallery.select_all()
-                    for child in medieval.main_window.display.gallery.get_selected_children():
-                        medieval.main_window.display.gallery.remove(child)
-
-                    # populate gallery with new media:
+                    # replace gallery media with the album media:
                     media = medieval.engine.query_media(album_id=self.album_id, password=self.provided_password)
-                    for entry in media:
-                        child = MediaFile(
-                            filename=entry['filename'],
-                            thumbnail=f'{config.THUMBNAIL_DIR}/{entry["thumbnail"]}.jpg',
-                            media_id=entry['id'],
-                            timestamp=entry['timestamp'],
-                            description=entry['description']
-                        )
-                        medieval.main_window.display.gallery.insert(child, -1)
-                        medieval.main_window.display.gallery.album_id = self.album_id
+                    medieval.main_window.display.gallery_store.splice(0, medieval.main_window.display.gallery_store.get_n_items(), [MediaItem.new_from_entry(entry) for entry in media])
+                    medieval.main_window.display.gallery.album_id = self.album_id
 
                     medieval.main_window.display.timeline_frame.set_visible(False)
                     medieval.main_window.display.gallery_frame.set_visible(True)
             else:
-                # remove old media:
-                medieval.main_window.display.gallery.select_all()
-                for child in medieval.main_window.display.gallery.get_selected_children():
-                    medieval.main_window.display.gallery.remove(child)
-
-                # populate gallery with new media:
+                # replace gallery media with the album media:
                 media = medieval.engine.query_media(album_id=self.album_id, password=self.provided_password)
-                for entry in media:
-                    child = MediaFile(
-                        filename=entry['filename'],
-                        thumbnail=f'{config.THUMBNAIL_DIR}/{entry["thumbnail"]}.jpg',
-                        mimetype=entry['mimetype'],
-                        media_id=entry['id'],
-                        timestamp=entry['timestamp'],
-                        description=entry['description']
-                    )
-                    medieval.main_window.display.gallery.insert(child, -1)
-                    medieval.main_window.display.gallery.album_id = self.album_id
+                medieval.main_window.display.gallery_store.splice(0, medieval.main_window.display.gallery_store.get_n_items(), [MediaItem.new_from_entry(entry) for entry in media])
+                medieval.main_window.display.gallery.album_id = self.album_id
 
                 medieval.main_window.display.visibility['timeline'] = False
                 medieval.main_window.display.visibility['gallery'] = True
@@ -312,32 +291,336 @@ class Album(gtk.Box):
     def on_dnd_leave(self, user_data):
         logging.info(f'in on_dnd_leave(); user_data={user_data}')
 
-class MediaFile(gtk.FlowBoxChild):
+class MediaItem(gobject.Object):
+    """
+    Model entry for a single media file. The timeline and the gallery hold a
+    MediaItem for every media, but only create MediaFile widgets for the
+    items in view.
+    """
+
     def __init__(self, *args, **kwargs):
         super().__init__()
 
         self.filename = kwargs.get('filename', None)
         self.thumbnail = kwargs.get('thumbnail', None)
+        self.preview = kwargs.get('preview', None)
         self.mimetype = kwargs.get('mimetype', None)
         self.media_id = kwargs.get('media_id', None)
         self.timestamp = kwargs.get('timestamp', None)
         self.description = kwargs.get('description', None)
 
+    # media columns needed by new_from_entry():
+    columns = ('id', 'filename', 'thumbnail', 'mimetype', 'timestamp', 'description')
+
+    @classmethod
+    def new_from_entry(cls, entry):
+        return cls(
+            filename=entry['filename'],
+            thumbnail=engine.preview_path(entry['thumbnail']),
+            preview=entry['thumbnail'],
+            mimetype=entry['mimetype'],
+            media_id=entry['id'],
+            timestamp=entry['timestamp'],
+            description=entry['description']
+        )
+
+    def __repr__(self):
+        return f'<MediaItem {self.filename}>'
+
+    def basename(self):
+        return os.path.basename(self.filename)
+
+def timeline_key(timestamp, media_id):
+    # the order of MedievalDB.query_media_page(): undated media first, then
+    # by timestamp and id.
+    return (timestamp is not None, timestamp, media_id)
+
+class TimelineKeys:
+    """
+    Read-only sequence of the timeline_key() of the items in a list store,
+    for bisecting it without copying.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store.get_n_items()
+
+    def __getitem__(self, position):
+        item = self.store.get_item(position)
+        return timeline_key(item.timestamp, item.media_id)
+
+def texture_from_image(image):
+    """
+    Wraps the pixels of an RGB or RGBA PIL @image (see
+    engine.convert_for_display()) in a texture. Textures are immutable, so
+    this can run in any thread.
+    """
+
+    memory_format = gdk.MemoryFormat.R8G8B8A8 if image.mode == 'RGBA' else gdk.MemoryFormat.R8G8B8
+    return gdk.MemoryTexture.new(image.width, image.height, memory_format, glib.Bytes.new(image.tobytes()), len(image.getbands())*image.width)
+
+def image_from_texture(texture):
+    """
+    Returns the pixels of @texture as an RGBA PIL image.
+    """
+
+    if not hasattr(gdk, 'TextureDownloader'):
+        # GTK < 4.10:
+        return Image.open(io.BytesIO(texture.save_to_png_bytes().get_data())).convert('RGBA')
+
+    downloader = gdk.TextureDownloader.new(texture)
+    downloader.set_format(gdk.MemoryFormat.R8G8B8A8)
+    data, stride = downloader.download_bytes()
+    return Image.frombuffer('RGBA', (texture.get_width(), texture.get_height()), data.get_data(), 'raw', 'RGBA', stride, 1)
+
+class AsyncTextureCache:
+    """
+    Memory-bounded LRU cache of textures that are loaded by a pool of
+    background threads and handed back on the main loop, which is the only
+    place the cache itself is touched. Subclasses define the cache key of
+    their items and decode() them.
+    """
+
+    def __init__(self, budget, workers, thread_name_prefix):
+        self.budget = budget
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=thread_name_prefix)
+
+        self.textures = collections.OrderedDict()
+        self.size = 0
+
+        # {key: (future, callbacks)} of the textures being loaded; prefetches
+        # have no callbacks:
+        self.requests = {}
+
+    def cached(self, key):
+        texture = self.textures.get(key, None)
+        if texture is not None:
+            self.textures.move_to_end(key)
+        return texture
+
+    def submit(self, key, item, *args, callback=None):
+        """
+        Loads the texture of @key in the background, unless it is already
+        being loaded, and adds @callback(item, texture) to the callbacks of
+        the request.
+        """
+
+        if key not in self.requests:
+            self.requests[key] = (self.pool.submit(self.load, key, item, *args), [])
+        if callback is not None:
+            self.requests[key][1].append(callback)
+
+    def withdraw(self, key, callback=None):
+        """
+        Withdraws @callback from the request of @key; the load is dropped if
+        it has not started yet and nobody else is waiting for it.
+        """
+
+        request = self.requests.get(key, None)
+        if request is None:
+            return
+
+        future, callbacks = request
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if len(callbacks) == 0 and future.cancel():
+            del self.requests[key]
+
+    def decode(self, item, *args):
+        raise NotImplementedError
+
+    def load(self, key, item, *args):
+        # runs in a worker thread.
+        try:
+            texture = self.decode(item, *args)
+        except Exception as e:
+            # a texture of None completes the request, so that the item can
+            # be asked for again:
+            logging.warning(f'failed to load {item}: {e!r}')
+            texture = None
+
+        glib.idle_add(self.on_loaded, key, item, texture)
+
+    def on_loaded(self, key, item, texture):
+        future, callbacks = self.requests.pop(key, (None, []))
+
+        if texture is not None:
+            self.insert(key, texture)
+
+        for callback in callbacks:
+            callback(item, texture)
+
+        return glib.SOURCE_REMOVE
+
+    def insert(self, key, texture):
+        if key in self.textures:
+            self.size -= self.texture_size(self.textures.pop(key))
+
+        self.textures[key] = texture
+        self.size += self.texture_size(texture)
+
+        while self.size > self.budget and len(self.textures) > 1:
+            key, evicted = self.textures.popitem(last=False)
+            self.size -= self.texture_size(evicted)
+
+    def texture_size(self, texture):
+        return 4*texture.get_width()*texture.get_height()
+
+class TextureCache(AsyncTextureCache):
+    """
+    Cache of thumbnail textures, shared by the timeline, the gallery and
+    the drag icons. Thumbnails are regenerated by the preview cache if
+    needed.
+    """
+
+    def __init__(self, budget=None, workers=None):
+        super().__init__(
+            budget=config.TEXTURE_CACHE_SIZE if budget is None else budget,
+            workers=config.THUMBNAIL_LOADERS if workers is None else workers,
+            thread_name_prefix='thumbnail-loader',
+        )
+
+    def key(self, item):
+        return item.preview if item.preview is not None else item.thumbnail
+
+    def lookup(self, item):
+        """
+        Returns the cached texture of @item, or None if it is not loaded.
+        """
+
+        return self.cached(self.key(item))
+
+    def request(self, item, callback):
+        """
+        Calls @callback(item, texture) with the thumbnail texture of @item:
+        right away if it is cached, otherwise once a background thread has
+        loaded it.
+        """
+
+        texture = self.lookup(item)
+        if texture is not None:
+            callback(item, texture)
+            return
+
+        self.submit(self.key(item), item, callback=callback)
+
+    def cancel(self, item, callback):
+        if item is not None:
+            self.withdraw(self.key(item), callback)
+
+    def decode(self, item):
+        if item.preview is not None:
+            path = medieval.engine.previews.get(item.preview, 256, item.filename, item.mimetype)
+        else:
+            path = item.thumbnail
+        return gdk.Texture.new_from_filename(path)
+
+class FrameCache(AsyncTextureCache):
+    """
+    Cache of display-ready viewer frames, keyed by the media and the size
+    they were decoded for.
+
+    Next to the frame requested for display, the viewer prefetches the
+    neighbours of the selected media, so flipping through the timeline or
+    an album finds them already decoded.
+    """
+
+    def __init__(self, budget=None, workers=None):
+        super().__init__(
+            budget=config.FRAME_CACHE_SIZE if budget is None else budget,
+            workers=config.FRAME_LOADERS if workers is None else workers,
+            thread_name_prefix='frame-loader',
+        )
+
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, media_file, width, height):
+        return (media_file.preview if media_file.preview is not None else media_file.filename, width, height)
+
+    def request(self, media_file, width, height, callback):
+        """
+        Calls @callback(media_file, texture) with the frame of @media_file
+        decoded for a @width x @height area: right away if it is cached,
+        otherwise once it has been loaded. The texture is None if the media
+        could not be decoded.
+        """
+
+        key = self.key(media_file, width, height)
+        texture = self.cached(key)
+        if texture is not None:
+            self.hits += 1
+            callback(media_file, texture)
+            return
+
+        self.misses += 1
+        self.submit(key, media_file, width, height, callback=callback)
+
+    def prefetch(self, media_files, width, height):
+        """
+        Loads the frames of the images among @media_files, in order, in the
+        background. The prefetches of any other media that have not started
+        yet are withdrawn, so that the loaders follow the selection.
+        """
+
+        keys = set()
+        for media_file in media_files:
+            if 'image' not in media_file.mimetype:
+                continue
+            key = self.key(media_file, width, height)
+            keys.add(key)
+            if key not in self.textures:
+                self.submit(key, media_file, width, height)
+
+        for key in list(self.requests):
+            if key not in keys:
+                self.withdraw(key)
+
+    def decode(self, media_file, width, height):
+        # load the smallest preview that covers the picture area:
+        if media_file.preview is None:
+            source = media_file.filename
+        else:
+            source = medieval.engine.previews.select(media_file.preview, media_file.filename, width, height)
+
+        return texture_from_image(engine.decode_for_display(source, width, height))
+
+    def statistics(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'frames': len(self.textures),
+            'size': self.size,
+            'budget': self.budget,
+        }
+
+class MediaFile(gtk.Box):
+    """
+    Grid cell that displays a MediaItem. Cells are recycled by the grid
+    view as it scrolls: bind() attaches a cell to an item and unbind()
+    detaches it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(orientation=gtk.Orientation.VERTICAL)
+
+        # list store that holds the displayed items:
+        self.store = kwargs.get('store', None)
+        self.item = None
+
         frame = gtk.Frame()
-        self.set_child(frame)
+        self.append(frame)
 
         vbox = gtk.Box(orientation=gtk.Orientation.VERTICAL)
         frame.set_child(vbox)
 
-        self.image = gtk.Image.new_from_file(self.thumbnail)
+        self.image = gtk.Image()
         self.image.set_pixel_size(256)
         vbox.append(self.image)
 
         self.label = gtk.EditableLabel()
-        if self.description:
-            self.label.set_text(self.description)
-        else:
-            self.label.set_text(self.basename())
         self.label.set_editable(False)
         self.label.connect('notify', self.media_description_changed)
         vbox.append(self.label)
@@ -367,11 +650,40 @@ class MediaFile(gtk.FlowBoxChild):
 
         self.insert_action_group('media', action_group)
 
+    def bind(self, item):
+        self.item = item
+
+        # show a placeholder until the thumbnail texture arrives:
+        self.image.set_from_icon_name('image-x-generic')
+        medieval.textures.request(item, self.on_texture_loaded)
+
+        if item.description:
+            self.label.set_text(item.description)
+        else:
+            self.label.set_text(item.basename())
+
+    def unbind(self):
+        medieval.textures.cancel(self.item, self.on_texture_loaded)
+        self.item = None
+        self.image.clear()
+
+    def on_texture_loaded(self, item, texture):
+        # the cell may have been recycled while the texture was loading:
+        if item is not self.item or texture is None:
+            return
+        self.image.set_from_paintable(texture)
+
+    # media properties are those of the bound item:
+    filename = property(lambda self: self.item.filename)
+    thumbnail = property(lambda self: self.item.thumbnail)
+    mimetype = property(lambda self: self.item.mimetype)
+    media_id = property(lambda self: self.item.media_id)
+
     def __repr__(self):
-        return f'<MediaFile {self.filename}>'
+        return f'<MediaFile {self.item}>'
 
     def basename(self):
-        return os.path.basename(self.filename)
+        return self.item.basename()
 
     def display_media_metadata(self, action, data):
         logging.info(f'display_media_metadata(): self={self}, action={action}, data={data}')
@@ -382,15 +694,14 @@ class MediaFile(gtk.FlowBoxChild):
             medieval.main_window.metadata_list.remove(child)
             child = medieval.main_window.metadata_list.get_first_child()
 
-        if 'image' in self.mimetype:
-            with Image.open(self.filename) as im:
-                entries = engine.import_exif(im)
-
-        elif 'video' in self.mimetype:
-            entries = engine.import_video_metadata(self.filename)
+        if 'image' in self.mimetype or 'video' in self.mimetype:
+            entries = medieval.engine.query_media_metadata(self.media_id)
+            if entries is None:
+                entries = medieval.engine.refresh_media_metadata(self.media_id)
 
         else:
             logging.info(f'mimetype {self.mimetype} not recognized.')
+            entries = {}
 
         for entry in entries:
             label = gtk.Label.new(f'{entry}={entries[entry]}')
@@ -416,29 +727,55 @@ class MediaFile(gtk.FlowBoxChild):
         logging.info(f'media_description_changed(): self={self}, label={label}, new_label={label.get_property("text")}')
         label.set_editable(False)
 
-        medieval.engine.update_media(media_id=self.media_id, description=label.get_property("text"))
+        self.item.description = label.get_property("text")
+        medieval.engine.update_media(media_id=self.media_id, description=self.item.description)
 
     def on_media_rotate(self, action, data):
         logging.info(f'on_media_rotate(): self={self}, action={action}, data={data}')
 
     def on_media_remove(self, action, data):
         logging.info(f'on_media_remove(): self={self}, action={action}, data={data}')
-        display = self.get_parent()
-        display.remove(self)
-        if display == medieval.main_window.display.timeline:
-            medieval.engine.remove_media(media_id=self.media_id)
-        elif display == medieval.main_window.display.gallery:
-            medieval.engine.remove_media_from_album(media_id=self.media_id, album_id=medieval.main_window.display.gallery.album_id)
+        media_id = self.media_id
+        found, position = self.store.find(self.item)
+        if found:
+            self.store.remove(position)
+
+        if self.store == medieval.main_window.display.timeline_store:
+            medieval.engine.remove_media(media_id=media_id)
+        elif self.store == medieval.main_window.display.gallery_store:
+            medieval.engine.remove_media_from_album(media_id=media_id, album_id=medieval.main_window.display.gallery.album_id)
         else:
             raise ValueError('how did we get here?')
 
     def on_media_delete(self, action, data):
         logging.info(f'on_media_delete(): self={self}, action={action}, data={data}')
-        print(self.get_parent(), self.get_parent() == medieval.main_window.display.timeline, self.get_parent() == medieval.main_window.display.gallery)
+        logging.debug(f'on_media_delete(): store={self.store}, timeline={self.store == medieval.main_window.display.timeline_store}, gallery={self.store == medieval.main_window.display.gallery_store}')
 
     def on_media_cast(self, action, data):
         logging.info(f'on_media_cast(). self={self}, action={action}, data={data}')
-        medieval.caster.play_media(f'http://192.168.1.13:8000/{self.filename[20:]}', 'image/jpg')
+
+        # the next media of the view are rendered in the background, in case
+        # they are cast next:
+        neighbours = []
+        found, position = self.store.find(self.item)
+        if found:
+            neighbours = [self.store.get_item(neighbour).media_id for neighbour in range(position+1, min(position+1+config.TRANSCODE_PREFETCH, self.store.get_n_items()))]
+
+        # looking the media up, probing them and talking to the cast device
+        # all block, so they are kept off the main loop:
+        medieval.cast_pool.submit(self.cast, self.media_id, neighbours)
+
+    def cast(self, media_id, neighbours):
+        # runs in the cast thread.
+        try:
+            url, mimetype = medieval.media_server.cast_source(media_id)
+            medieval.caster.play_media(url, mimetype)
+
+            if medieval.media_server.transcoder is not None:
+                for neighbour in neighbours:
+                    medieval.media_server.transcoder.submit(neighbour)
+        except Exception as e:
+            logging.error(f'failed to cast media_id={media_id}: {e!r}')
 
     def on_media_rightclicked(self, click, n_press, x, y):
         print(f'on_media_rightclicked(): self={self}, click={click}, n_press={n_press}, x={x}, y={y}')
@@ -470,19 +807,24 @@ class DisplayPanel(gtk.Paned):
         self.set_start_child(gallery_panel)
 
         # timeline frame (visible by default):
-        self.timeline = gtk.FlowBox(homogeneous=True, column_spacing=5, row_spacing=5, valign=gtk.Align.START, halign=gtk.Align.FILL, activate_on_single_click=False, selection_mode=gtk.SelectionMode.MULTIPLE)
-        self.timeline.connect('child-activated', self.on_media_selected)
-        
+        self.timeline_store, self.timeline = self.create_media_view()
+
+        # the timeline is loaded one page at a time as it is scrolled:
+        self.timeline_ids = set()
+        self.timeline_after = None
+        self.timeline_exhausted = False
+
         scrolled_panel = gtk.ScrolledWindow(hscrollbar_policy=gtk.PolicyType.NEVER, vscrollbar_policy=gtk.PolicyType.AUTOMATIC, hexpand=True, vexpand=True)
         scrolled_panel.set_child(self.timeline)
-                
+        scrolled_panel.get_vadjustment().connect('value-changed', self.on_timeline_scrolled)
+
         self.timeline_frame = gtk.Frame(label='Timeline', hexpand=True, vexpand=True)
         self.timeline_frame.set_child(scrolled_panel)
         gallery_panel.append(self.timeline_frame)
 
         # gallery (album) frame (invisible by default):
-        self.gallery = gtk.FlowBox(homogeneous=True, column_spacing=5, row_spacing=5, valign=gtk.Align.START, halign=gtk.Align.FILL, activate_on_single_click=False, selection_mode=gtk.SelectionMode.MULTIPLE)
-        self.gallery.connect('child-activated', self.on_media_selected)
+        self.gallery_store, self.gallery = self.create_media_view()
+        self.gallery.album_id = None
         scrolled_panel = gtk.ScrolledWindow(hscrollbar_policy=gtk.PolicyType.NEVER, vscrollbar_policy=gtk.PolicyType.AUTOMATIC, hexpand=True, vexpand=True)
         scrolled_panel.set_child(self.gallery)
 
@@ -541,17 +883,119 @@ class DisplayPanel(gtk.Paned):
             'picture': False
         }
 
+        # the media shown in the viewer, as a position in a timeline or
+        # gallery view; frames of earlier selections that arrive late are
+        # dropped by their generation:
+        self.picture_view = None
+        self.picture_position = None
+        self.picture_generation = 0
+
         # Precompute portrait and landscape drop shadows:
-        self.drop_shadows = {}
-        self.drop_shadows['256x192'] = self.drop_shadow(size=(256, 192), iterations=10, border=8, offset=(0, 0))
-        self.drop_shadows['192x256'] = self.drop_shadow(size=(192, 256), iterations=10, border=8, offset=(0, 0))
+        self.drop_shadows = collections.OrderedDict()
+        self.drop_shadow(size=(256, 192))
+        self.drop_shadow(size=(192, 256))
 
     def __repr__(self):
         return f'<DisplayPanel {self.name}>'
 
-    def drop_shadow(self, size, iterations, border, offset, background_color=(0, 0, 0, 1)):
-        shadow = self.drop_shadows.get(f'{size[0]}x{size[1]}', None)
-        if shadow:
+    def create_media_view(self):
+        """
+        Creates a grid view over a list store of MediaItems. The grid only
+        instantiates MediaFile widgets for the visible items and recycles
+        them while scrolling. Returns the store and the view.
+        """
+
+        store = gio.ListStore(item_type=MediaItem)
+        selection = gtk.MultiSelection.new(store)
+
+        factory = gtk.SignalListItemFactory()
+        factory.connect('setup', self.on_media_setup, store)
+        factory.connect('bind', self.on_media_bind)
+        factory.connect('unbind', self.on_media_unbind)
+
+        view = gtk.GridView(model=selection, factory=factory, max_columns=64, enable_rubberband=True, single_click_activate=False, hexpand=True, vexpand=True)
+        view.connect('activate', self.on_media_selected)
+
+        return store, view
+
+    def append_to_timeline(self, entries):
+        """
+        Appends media rows to the timeline, skipping any that are already in
+        it (for example imported media that a later page also returns).
+        """
+
+        items = [MediaItem.new_from_entry(entry) for entry in entries if entry['id'] not in self.timeline_ids]
+        self.timeline_ids.update(item.media_id for item in items)
+        self.timeline_store.splice(self.timeline_store.get_n_items(), 0, items)
+
+    def insert_into_timeline(self, entries):
+        """
+        Inserts media rows that did not come from the timeline pages (for
+        example freshly imported media) at their place in the timeline. Rows
+        past the last loaded page are left to the pages that load them, so
+        the timeline stays in order and the paging cursor stays valid.
+        """
+
+        for entry in entries:
+            if entry['id'] in self.timeline_ids:
+                continue
+
+            key = timeline_key(entry['timestamp'], entry['id'])
+            if not self.timeline_exhausted and (self.timeline_after is None or key > timeline_key(*self.timeline_after)):
+                continue
+
+            position = bisect.bisect(TimelineKeys(self.timeline_store), key)
+            self.timeline_store.insert(position, MediaItem.new_from_entry(entry))
+            self.timeline_ids.add(entry['id'])
+
+    def load_timeline_page(self):
+        """
+        Loads the next page of the timeline. Returns True if there may be
+        more pages.
+        """
+
+        if self.timeline_exhausted:
+            return False
+
+        page = medieval.engine.query_media_page(after=self.timeline_after, columns=MediaItem.columns)
+        if len(page) == 0:
+            self.timeline_exhausted = True
+            return False
+
+        self.timeline_after = (page[-1]['timestamp'], page[-1]['id'])
+        self.append_to_timeline(page)
+        return True
+
+    def on_timeline_scrolled(self, adjustment):
+        # keep at least two screens of media below the visible area:
+        if adjustment.get_value() + 3*adjustment.get_page_size() >= adjustment.get_upper():
+            self.load_timeline_page()
+
+    def on_media_setup(self, factory, list_item, store):
+        list_item.set_child(MediaFile(store=store))
+
+    def on_media_bind(self, factory, list_item):
+        list_item.get_child().bind(list_item.get_item())
+
+    def on_media_unbind(self, factory, list_item):
+        list_item.get_child().unbind()
+
+    def selected_media(self, view):
+        selection = view.get_model()
+        bitset = selection.get_selection()
+        return [selection.get_item(bitset.get_nth(i)) for i in range(bitset.get_size())]
+
+    def drop_shadow(self, size, border=8, offset=(0, 0), radius=5, background_color=(0, 0, 0, 1)):
+        """
+        Returns the drop shadow sprite of an image of @size, blurred over
+        @border pixels around it. Sprites are cached by their parameters,
+        so each thumbnail size is blurred only once.
+        """
+
+        key = (tuple(size), border, tuple(offset), radius)
+        shadow = self.drop_shadows.get(key, None)
+        if shadow is not None:
+            self.drop_shadows.move_to_end(key)
             return shadow
 
         # calculate the size of the shadow image
@@ -564,81 +1008,114 @@ class DisplayPanel(gtk.Paned):
         shadow_top  = border + max(offset[1], 0)
 
         shadow.paste('black', [shadow_left, shadow_top, shadow_left + size[0], shadow_top  + size[1]])
-        
-        for i in range(iterations):
-            shadow = shadow.filter(ImageFilter.BLUR)
 
+        # a single Gaussian pass, about as wide as the ten box blurs it replaces:
+        shadow = shadow.filter(ImageFilter.GaussianBlur(radius))
+
+        self.drop_shadows[key] = shadow
+        if len(self.drop_shadows) > 64:
+            self.drop_shadows.popitem(last=False)
         return shadow
 
-    def create_drag_icon(self, media):
+    def drag_thumbnail(self, item):
+        """
+        Returns the thumbnail of @item as a PIL image, from the texture cache
+        if it is loaded and from disk otherwise.
+        """
+
+        texture = medieval.textures.lookup(item)
+        if texture is not None:
+            return image_from_texture(texture)
+
+        try:
+            return Image.open(item.thumbnail).convert('RGBA')
+        except OSError as e:
+            logging.warning(f'failed to load the thumbnail of {item}: {e}')
+            return Image.new('RGBA', (256, 192), 'grey')
+
+    def create_drag_icon(self, items):
+        """
+        Renders the drag icon of the MediaItems @items: the first thumbnail
+        on top of a stack that hints at the size of the selection. Only the
+        (at most four) thumbnails that are drawn are fetched, however many
+        items are dragged. Returns the icon texture.
+        """
+
+        count = len(items)
+        indices = range(count) if count <= 3 else (0, 1, 2, count-1)
+        media = {index: self.drag_thumbnail(items[index]) for index in indices}
+
         # Set width and height as the largest thumbnail width/height capped at 256.
         # Capping is un-necessary because thumbnails are already capped to 256, but
         # it doesn't really hurt.
-        width = min(max([medium.width for medium in media]), 256)
-        height = min(max([medium.height for medium in media]), 256)
+        width = min(max([medium.width for medium in media.values()]), 256)
+        height = min(max([medium.height for medium in media.values()]), 256)
         
         # The final width and height need to accommodate for shadow size as well.
-        composite = Image.new(mode='RGBA', size=(width+16*min(len(media), 2), height+16*min(len(media), 2)), color=(0, 0, 0, 1))
+        composite = Image.new(mode='RGBA', size=(width+16*min(count, 2), height+16*min(count, 2)), color=(0, 0, 0, 1))
 
-        if len(media) == 1:
-            shadow = self.drop_shadow(media[0].getbbox()[2:], 10, 8, (0, 0))
+        first, last = media[0], media[count-1]
+        if count == 1:
+            shadow = self.drop_shadow(first.size)
             composite.paste(shadow, (0, 0, shadow.width, shadow.height))
-            composite.paste(media[0], (8, 8, 8+media[0].width, 8+media[0].height))
-        elif len(media) == 2:
-            shadow1 = self.drop_shadow(media[1].getbbox()[2:], 10, 8, (0, 0))
-            shadow2 = self.drop_shadow(media[0].getbbox()[2:], 10, 8, (0, 0))
+            composite.paste(first, (8, 8, 8+first.width, 8+first.height))
+        elif count == 2:
+            shadow1 = self.drop_shadow(last.size)
+            shadow2 = self.drop_shadow(first.size)
             composite.paste(shadow1, (16, 16, 16+shadow1.width, 16+shadow1.height))
-            composite.paste(media[1], (24, 24, 24+media[1].width, 24+media[1].height))
+            composite.paste(last, (24, 24, 24+last.width, 24+last.height))
             composite.alpha_composite(shadow2, (0, 0))
-            composite.paste(media[0], (8, 8, 8+media[0].width, 8+media[0].height))
-        elif len(media) == 3:
-            shadow1 = self.drop_shadow(media[2].getbbox()[2:], 10, 8, (0, 0))
-            shadow2 = self.drop_shadow(media[0].getbbox()[2:], 10, 8, (0, 0))
+            composite.paste(first, (8, 8, 8+first.width, 8+first.height))
+        elif count == 3:
+            shadow1 = self.drop_shadow(last.size)
+            shadow2 = self.drop_shadow(first.size)
             composite.paste(shadow1, (16, 16, 16+shadow1.width, 16+shadow1.height))
             composite.paste(media[1], (24, 24, 24+media[1].width, 24+media[1].height))
             composite.alpha_composite(shadow2, (8, 8))
             composite.paste('grey', (16, 16, 16+media[1].width, 16+media[1].height))
             composite.alpha_composite(shadow2, (0, 0))
-            composite.paste(media[0], (8, 8, 8+media[0].width, 8+media[0].height))
+            composite.paste(first, (8, 8, 8+first.width, 8+first.height))
         else:
-            shadow1 = self.drop_shadow(media[-1].getbbox()[2:], 10, 8, (0, 0))
-            shadow2 = self.drop_shadow(media[0].getbbox()[2:], 10, 8, (0, 0))
+            shadow1 = self.drop_shadow(last.size)
+            shadow2 = self.drop_shadow(first.size)
             composite.paste(shadow1, (16, 16, 16+shadow1.width, 16+shadow1.height))
-            composite.paste(media[-1], (24, 24, 24+media[-1].width, 24+media[-1].height))
+            composite.paste(last, (24, 24, 24+last.width, 24+last.height))
             composite.alpha_composite(shadow2, (10, 10))
             composite.paste('grey', (18, 18, 18+media[2].width, 18+media[2].height))
             composite.alpha_composite(shadow2, (6, 6))
             composite.paste('grey', (14, 14, 14+media[1].width, 14+media[1].height))
             composite.alpha_composite(shadow2, (0, 0))
-            composite.paste(media[0], (8, 8, 8+media[0].width, 8+media[0].height))
+            composite.paste(first, (8, 8, 8+first.width, 8+first.height))
 
-        buffer = glib.Bytes.new(composite.tobytes())
-        gdata = GdkPixbuf.Pixbuf.new_from_bytes(buffer, GdkPixbuf.Colorspace.RGB, True, 8, composite.width, composite.height, len(composite.getbands())*composite.width)
-        return gtk.Image.new_from_pixbuf(gdata)
+        return texture_from_image(composite)
 
-    def on_media_selected(self, gallery, media_file):
+    def on_media_selected(self, gallery, position):
         """
         Displays the selected media from the gallery in the media panel. The
         function checks mimetype of the media and adjusts the widget that
         displays the media accordingly.
 
-        * `gallery`: parent gallery that contains the selected `MediaFile`
-          instance
-        * `media_file`: selected `MediaFile` instance
+        * `gallery`: grid view (timeline or gallery) that contains the
+          selected media
+        * `position`: position of the selected `MediaItem` in the view
         """
+        media_file = gallery.get_model().get_item(position)
         logging.info(f'on_media_selected(); gallery={gallery}, media_file={media_file}')
 
+        # supersede any picture that is still loading:
+        self.picture_generation += 1
+        self.picture_view = gallery
+        self.picture_position = position
+
+        # frames are decoded at the size of the picture area, in device pixels:
+        scale = self.picture_area.get_scale_factor()
+        width, height = scale*self.picture_area.get_width(), scale*self.picture_area.get_height()
+
         if 'image' in media_file.mimetype:
-            pimage = Image.open(media_file.filename)
-            pimage = ImageOps.exif_transpose(pimage)
-            pdata = glib.Bytes.new(pimage.tobytes())
-            gdata = GdkPixbuf.Pixbuf.new_from_bytes(pdata, GdkPixbuf.Colorspace.RGB, False, 8, pimage.width, pimage.height, len(pimage.getbands())*pimage.width)
-            picture = gtk.Picture.new_for_pixbuf(gdata)
+            medieval.frames.request(media_file, width, height, functools.partial(self.on_picture_loaded, self.picture_generation))
+            medieval.frames.prefetch(self.picture_neighbours(gallery.get_model(), position), width, height)
 
-            picture.set_can_shrink(True)
             self.picture_frame.get_child().set_label(media_file.basename())
-            self.picture_area.set_child(picture)
-            self.picture_area.grab_focus()
             self.picture_frame.set_visible(True)
 
         elif 'video' in media_file.mimetype:
@@ -652,6 +1129,31 @@ class DisplayPanel(gtk.Paned):
         else:
             logging.warning(f'mimetype {media_file.mimetype} not recognized.')
 
+    def picture_neighbours(self, model, position):
+        """
+        Returns the images next to @position in @model, nearest first and
+        alternating between the following and the preceding ones.
+        """
+
+        neighbours = []
+        for distance in range(1, config.FRAME_PREFETCH+1):
+            for neighbour in (position+distance, position-distance):
+                if 0 <= neighbour < model.get_n_items():
+                    media_file = model.get_item(neighbour)
+                    if 'image' in media_file.mimetype:
+                        neighbours.append(media_file)
+        return neighbours
+
+    def on_picture_loaded(self, generation, media_file, texture):
+        if generation != self.picture_generation or texture is None:
+            # another media has been selected in the meantime:
+            return
+
+        picture = gtk.Picture.new_for_paintable(texture)
+        picture.set_can_shrink(True)
+        self.picture_area.set_child(picture)
+        self.picture_area.grab_focus()
+
     def on_album_closed(self, button):
         logging.info(f'on_album_closed(): self={self}, button={button}')
         self.gallery_frame.set_visible(False)
@@ -667,8 +1169,9 @@ class DisplayPanel(gtk.Paned):
             self.gallery_frame.set_visible(True)
 
     def on_dnd_prepare(self, drag_source, x, y):
-        media = gio.ListStore()
-        media.splice(0, 0, self.timeline.get_selected_children())
+        selected = self.selected_media(self.timeline)
+        media = gio.ListStore(item_type=MediaItem)
+        media.splice(0, 0, selected)
         num_items = media.get_n_items()
         logging.info(f'in on_dnd_prepare(); drag_source={drag_source}, x={x}, y={y}, data={media}, num_items={num_items}')
         if num_items == 0:
@@ -677,9 +1180,8 @@ class DisplayPanel(gtk.Paned):
         passed_data = gobject.Value(gio.ListModel, media)
         content = gdk.ContentProvider.new_for_value(passed_data)
 
-        thumbnails = [Image.open(entry.thumbnail) for entry in self.timeline.get_selected_children()]
-        drag_image = self.create_drag_icon(thumbnails)
-        drag_source.set_icon(drag_image.get_paintable(), 128, 128)  # TODO: consider a better hot_x, hot_y default
+        drag_icon = self.create_drag_icon(selected)
+        drag_source.set_icon(drag_icon, 128, 128)  # TODO: consider a better hot_x, hot_y default
         
         return content
 
@@ -696,6 +1198,14 @@ class DisplayPanel(gtk.Paned):
             self.picture_frame.set_visible(False)
             self.gallery_frame.set_visible(True)
             return True
+        if keyval in (gdk.KEY_Left, gdk.KEY_Right) and self.picture_view is not None:
+            # flip to the previous or next media of the view:
+            model = self.picture_view.get_model()
+            position = self.picture_position + (1 if keyval == gdk.KEY_Right else -1)
+            if 0 <= position < model.get_n_items():
+                model.select_item(position, True)
+                self.on_media_selected(self.picture_view, position)
+            return True
         return False
 
     def on_picture_clicked(self, click, n_press, x, y):
@@ -777,23 +1287,10 @@ class PasswordPrompt(gtk.Dialog):
                     self.album.locked_icon.set_visible(False)
                     self.album.unlocked_icon.set_visible(True)
 
-                    # remove old media:
-                    medieval.main_window.display.gallery.select_all()
-                    for child in medieval.main_window.display.gallery.get_selected_children():
-                        medieval.main_window.display.gallery.remove(child)
-
-                    # populate gallery with new media:
+                    # replace gallery media with the album media:
                     media = medieval.engine.query_media(album_id=self.album.album_id, password=password)
-                    for entry in media:
-                        child = MediaFile(
-                            filename=entry['filename'],
-                            thumbnail=f'{config.THUMBNAIL_DIR}/{entry["thumbnail"]}.jpg',
-                            mimetype=entry['mimetype'],
-                            media_id=entry['id'],
-                            timestamp=entry['timestamp'],
-                            description=entry['description']
-                        )
-                        medieval.main_window.display.gallery.insert(child, -1)
+                    medieval.main_window.display.gallery_store.splice(0, medieval.main_window.display.gallery_store.get_n_items(), [MediaItem.new_from_entry(entry) for entry in media])
+                    medieval.main_window.display.gallery.album_id = self.album.album_id
 
                     medieval.main_window.display.timeline_frame.set_visible(False)
                     medieval.main_window.display.gallery_frame.set_visible(True)
@@ -841,6 +1338,72 @@ class PasswordPrompt(gtk.Dialog):
             self.album.provided_password = None
             widget.close()
 
+class ImportProgress(gtk.Box):
+    """
+    Status row of a background import (see engine.ImportJob). The job calls
+    back from its own thread, so every callback is handed to the main loop:
+    committed batches are inserted into the timeline and the counters are
+    refreshed as they come in. The row removes itself a few seconds after
+    the import has finished.
+    """
+
+    def __init__(self, job, display, *args, **kwargs):
+        super().__init__(*args, orientation=gtk.Orientation.HORIZONTAL, spacing=5, **kwargs)
+
+        self.job = job
+        self.display = display
+
+        job.on_batch = lambda job, rows: glib.idle_add(self.on_batch, rows)
+        job.on_progress = lambda job: glib.idle_add(self.on_progress)
+        job.on_done = lambda job: glib.idle_add(self.on_done)
+
+        self.label = gtk.Label(hexpand=True, xalign=0)
+        self.append(self.label)
+
+        self.cancel_button = gtk.Button(label='Cancel')
+        self.cancel_button.connect('clicked', self.on_cancel_clicked)
+        self.append(self.cancel_button)
+
+        self.update()
+
+    def __repr__(self):
+        return f'<ImportProgress {self.job}>'
+
+    def update(self):
+        progress = self.job.progress()
+        if self.job.error is not None:
+            state = 'Import failed'
+        elif progress['finished']:
+            state = 'Import cancelled' if progress['cancelled'] else 'Imported'
+        else:
+            state = 'Cancelling import of' if progress['cancelled'] else 'Importing'
+
+        self.label.set_text(f'{state} {", ".join(self.job.paths)}: {progress["seen"]} seen, {progress["imported"]} imported, {progress["skipped"]} skipped, {progress["failed"]} failed ({progress["throughput"]:.1f} files/s)')
+
+    def on_batch(self, rows):
+        self.display.insert_into_timeline(rows)
+        return glib.SOURCE_REMOVE
+
+    def on_progress(self):
+        self.update()
+        return glib.SOURCE_REMOVE
+
+    def on_done(self):
+        self.update()
+        self.cancel_button.set_visible(False)
+        medieval.imports.discard(self.job)
+        glib.timeout_add_seconds(5, self.on_expired)
+        return glib.SOURCE_REMOVE
+
+    def on_expired(self):
+        self.get_parent().remove(self)
+        return glib.SOURCE_REMOVE
+
+    def on_cancel_clicked(self, button):
+        self.job.cancel()
+        self.cancel_button.set_sensitive(False)
+        self.update()
+
 class Importer(gtk.FileChooserDialog):
     def __init__(self, parent, select_multiple):
         super().__init__(transient_for=parent, use_header_bar=True)
@@ -863,17 +1426,18 @@ class Importer(gtk.FileChooserDialog):
 
     def dialog_response(self, widget, response):
         if response == gtk.ResponseType.OK:
-            media_list = medieval.engine.import_media_from_directory(self.get_file().get_path())
-            for entry in media_list:
-                child = MediaFile(
-                    filename=entry['filename'],
-                    thumbnail=f'{config.THUMBNAIL_DIR}/{entry["thumbnail"]}.jpg',
-                    mimetype=entry['mimetype'],
-                    media_id=entry['id'],
-                    timestamp=entry['timestamp'],
-                    description=entry['description']
-                )
-                self.parent.display.timeline.insert(child, -1)
+            # the import runs in the background and reports to a status row
+            # of the main window:
+            if self.select_multiple:
+                files = self.get_files()
+                paths = [files.get_item(i).get_path() for i in range(files.get_n_items())]
+            else:
+                paths = [self.get_file().get_path()]
+
+            job = engine.ImportJob(paths)
+            self.parent.imports.append(ImportProgress(job, self.parent.display))
+            medieval.imports.add(job)
+            job.start(medieval.engine)
 
         elif response == gtk.ResponseType.CANCEL:
             logging.info("Cancel clicked")
@@ -969,6 +1533,10 @@ class MedievalWindow(gtk.ApplicationWindow):
 
         main_panel.set_end_child(self.metadata_frame)
 
+        # status rows of the running imports:
+        self.imports = gtk.Box(orientation=gtk.Orientation.VERTICAL, spacing=5)
+        vbox.append(self.imports)
+
         button = gtk.Button(label='Quit')
         button.connect('clicked', lambda _: app.quit())
         vbox.append(button)
@@ -1007,7 +1575,7 @@ class MedievalWindow(gtk.ApplicationWindow):
         logging.info(f'on_new_clicked(); action={action}, parameter={parameter}, app={app}')
 
     def on_import_clicked(self, action, parameter, app):
-        Importer(self, False)
+        Importer(self, True)
 
 class MedievalApp(gtk.Application):
     def __init__(self, *args, **kwargs):
@@ -1018,7 +1586,14 @@ class MedievalApp(gtk.Application):
         gtk.Application.do_startup(self)
 
         self.engine = engine.MedievalDB()
-        # self.caster = engine.init_chromecast()
+        self.textures = TextureCache()
+        self.frames = FrameCache()
+        self.imports = set()
+        self.cast_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cast')
+        # previews orphaned by earlier versions, or by rows deleted behind
+        # the library's back, are collected without holding up the window:
+        threading.Thread(target=self.engine.collect_preview_garbage, name='preview-gc', daemon=True).start()
+        # self.media_server, self.caster = engine.init_chromecast(self.engine)
         
         action = gio.SimpleAction.new('quit', None)
         action.connect('activate', self.on_quit)
@@ -1030,18 +1605,9 @@ class MedievalApp(gtk.Application):
         if not self.main_window:
             self.main_window = MedievalWindow(title='Medieval -- Media Organizer', application=self, default_width=1600, default_height=800)
 
-            # Populate the timeline with thumbnails:
-            media_list = self.engine.query_media()
-            for entry in media_list:
-                child = MediaFile(
-                    filename=entry['filename'],
-                    thumbnail=f'{config.THUMBNAIL_DIR}/{entry["thumbnail"]}.jpg',
-                    mimetype=entry['mimetype'],
-                    media_id=entry['id'],
-                    timestamp=entry['timestamp'],
-                    description=entry['description']
-                )
-                self.main_window.display.timeline.insert(child, -1)
+            # Populate the timeline with the first page of thumbnails; the
+            # rest is loaded as the timeline is scrolled:
+            self.main_window.display.load_timeline_page()
 
             # Populate collections:
             collection_list = self.engine.query_collections()
@@ -1062,6 +1628,10 @@ class MedievalApp(gtk.Application):
 
     def do_shutdown(self):
         logging.info('in do_shutdown()')
+        # stop the running imports; what they have committed so far stays:
+        for job in list(self.imports):
+            job.cancel()
+            job.wait()
         gtk.Application.do_shutdown(self)
 
     def on_quit(self, action, param):